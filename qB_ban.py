@@ -1,118 +1,1740 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import atexit
+import bisect
+import functools
+import ipaddress
+import logging
+import mmap
+import operator
+import os
+import queue
 import re
+import socket
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from logging.config import dictConfig
 from logging import Formatter, getLogger
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from pprint import pformat
+from urllib.parse import urlsplit
 
 import requests
 import json
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
-def get_torrents(
-    url, /, state: str = None, category: str = None, tag: str = None,
-    sort: str = None, reverse: bool = False, limit: int = None,
-    offset: int = None, hashes: list = None
-) -> list[dict]:
-    content = {'rid': 0}
-    if state:
-        content.update(filter=state)
-    if category:
-        content.update(category=category)
-    if tag:
-        content.update(tag=tag)
-    if sort:
-        content.update(sort=sort)
-    if reverse:
-        content.update(reverse=reverse)
-    if limit:
-        content.update(limit=limit)
-    if offset:
-        content.update(offset=offset)
-    if hashes:
-        content.update(hashes="|".join(hashes))
-    res = requests.get(url, params=content)
-    if res.status_code != 200:
-        return []
-    return json.loads(res.text)
-
-
-def get_peers(url, hash_id) -> list[dict]:
-    content = {'rid': 0, 'hash': hash_id}
-    res = requests.get(url, params=content)
-    if res.status_code != 200:
-        return []
-    return json.loads(res.text)['peers']
-
-
-def ban_peers(url, peers: list):
+
+log = getLogger()
+# 屏蔽记录, 每条一行 JSON
+audit_log = getLogger("qB_ban.audit")
+
+
+class AuditFormatter(Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z")}
+        entry.update(
+            getattr(record, "audit", {"message": record.getMessage()})
+        )
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def queue_logging(logger) -> QueueListener:
+    """
+    把 logger 的 handler 移到后台线程中执行,
+    调用 log 的线程只把记录放入队列, 不会等待磁盘 I/O。
+    """
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def ban_peers(url, peers: list, session: requests.Session = None):
     peers = "|".join(peers)
     content = {"peers": peers}
-    return requests.post(url, data=content)
+    return (session or requests).post(url, data=content)
+
+
+class Metrics(object):
+    """
+    Prometheus 文本格式的 counter 和 histogram,
+    serve() 启动一个 HTTP 导出器, write() 写入 node_exporter 的 textfile 目录。
+    """
+
+    buckets = (
+        0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+    )
+    help = {
+        "webui_request_seconds": ("histogram", "WebUI request latency."),
+        "webui_errors_total": ("counter", "WebUI requests that failed."),
+        "sweep_seconds": ("histogram", "Time spent on one polling round."),
+        "torrents_polled_total": ("counter", "Torrent peer lists fetched."),
+        "peers_evaluated_total": ("counter", "Peers checked by the policy."),
+        "policy_seconds": ("histogram", "BanPeerPolicy evaluation time."),
+        "bans_total": ("counter", "Peers banned, by policy group and rule."),
+        "ban_requests_total": ("counter", "banPeers requests sent."),
+        "bans_coalesced_total": (
+            "counter", "Duplicate bans merged before sending."
+        ),
+    }
+
+    def __init__(self, prefix: str = "qb_ban"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [每个 bucket 的计数..., sum, count]
+        self.histograms = {}
+        self.last_write = 0
+
+    def inc(self, name, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = \
+                    [0] * (len(self.buckets) + 2)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(
+            '%s="%s"' % (
+                k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                .replace("\n", "\\n")
+            )
+            for k, v in labels
+        ) + "}"
+
+    def render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(value)) for key, value in self.histograms.items()
+            )
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, text = self.help.get(name, ("untyped", name))
+                lines.append(f"# HELP {self.prefix}_{name} {text}")
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(
+                f"{self.prefix}_{name}{self._labels(labels)} {value}"
+            )
+        for (name, labels), histogram in histograms:
+            describe(name)
+            cumulative = 0
+            for le, count in zip(
+                [*map(str, self.buckets), "+Inf"], histogram[:-2]
+            ):
+                cumulative += count
+                lines.append(
+                    f"{self.prefix}_{name}_bucket"
+                    f"{self._labels(labels, [('le', le)])} {cumulative}"
+                )
+            lines.append(
+                f"{self.prefix}_{name}_sum{self._labels(labels)} "
+                f"{histogram[-2]}"
+            )
+            lines.append(
+                f"{self.prefix}_{name}_count{self._labels(labels)} "
+                f"{histogram[-1]}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, addr: str = "127.0.0.1"):
+        """
+        在后台线程中提供 http://addr:port/metrics
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        threading.Thread(
+            target=server.serve_forever, name="metrics", daemon=True
+        ).start()
+        return server
+
+    def write(self, path):
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def maybe_write(self, path, interval: float = 15):
+        now = time.monotonic()
+        if now - self.last_write >= interval:
+            self.last_write = now
+            self.write(path)
+
+
+metrics = Metrics()
+
+
+class WebUISession(requests.Session):
+    """
+    所有 WebUI 请求共用的会话: 连接池复用 TCP 连接 (keep-alive),
+    保存登录后的 SID cookie, 连接失败或 5xx 时按 backoff_factor 退避重试,
+    cookie 失效 (403) 时重新登录一次。
+    """
+
+    def __init__(
+        self, root_url, username: str = None, password: str = None,
+        pool_size: int = 10, retries: int = 3, backoff_factor: float = 0.5,
+        timeout: float = 10
+    ):
+        super().__init__()
+        self.root_url = root_url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.headers["Referer"] = root_url
+        retry = Retry(
+            total=retries, backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504), allowed_methods=None,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def login(self) -> bool:
+        if not self.username:
+            # 开启了 "对本地主机上的客户端跳过身份验证"
+            return True
+        res = super().request(
+            "POST", self.root_url + "/api/v2/auth/login",
+            data={"username": self.username, "password": self.password},
+            timeout=self.timeout,
+        )
+        if res.status_code != 200 or res.text.strip() != "Ok.":
+            log.error(f"login failed: {res.status_code} {res.text}")
+            return False
+        return True
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = urlsplit(url).path
+        try:
+            with metrics.time("webui_request_seconds", endpoint=endpoint):
+                res = super().request(method, url, *args, **kwargs)
+                if res.status_code == 403 and self.username and self.login():
+                    res = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            metrics.inc("webui_errors_total", endpoint=endpoint)
+            raise
+        if res.status_code != 200:
+            metrics.inc("webui_errors_total", endpoint=endpoint)
+        return res
+
+
+class BanCache(object):
+    """
+    记录已经屏蔽的 peer, ttl 秒内不再检查, 超过 maxsize 时淘汰最久未使用的,
+    保存到 path 以便重启后不会再次屏蔽同一批 peer。
+    by_client 为 True 时以 ip 和客户端名称作为 key。
+    """
+
+    def __init__(
+        self, path=None, ttl: float = 24 * 3600, maxsize: int = 65536,
+        by_client: bool = False, save_interval: float = 60
+    ):
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.by_client = by_client
+        self.save_interval = save_interval
+        # key -> 过期时间, 使用 time.time() 以便保存到文件
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.last_save = time.monotonic()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, peer) -> str:
+        if self.by_client:
+            return f"{peer['ip']}|{peer.get('client', '')}"
+        return peer["ip"]
+
+    def __contains__(self, peer) -> bool:
+        key = self.key(peer)
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self.entries[key]
+                self.dirty = True
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, peer):
+        key = self.key(peer)
+        with self.lock:
+            self.entries[key] = time.time() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def load(self):
+        if not self.path or not self.path.exists():
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            log.error(f"load ban cache {self.path} failed: {e!r}")
+            return
+        now = time.time()
+        for key, expires in sorted(entries.items(), key=lambda i: i[1]):
+            if expires > now:
+                self.entries[key] = expires
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        log.info(f"loaded {len(self.entries)} banned peers from {self.path}")
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            entries = dict(self.entries)
+            self.dirty = False
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+
+    def maybe_save(self):
+        if time.monotonic() - self.last_save >= self.save_interval:
+            self.save()
+
+
+class BanQueue(object):
+    """
+    收集各个 torrent 中检测到的 leech, 按 ip 去重,
+    每隔 interval 秒或达到 batch_size 时通过一次 banPeers 请求提交,
+    提交成功后才把 peer 记录到 ban_cache。
+    """
+
+    def __init__(
+        self, url, interval: float = 1, batch_size: int = 100,
+        session: requests.Session = None, ban_cache: BanCache = None
+    ):
+        self.url = url
+        self.session = session
+        self.ban_cache = ban_cache
+        self.interval = interval
+        self.batch_size = batch_size
+        # ip -> (ip:port, peer), qBittorrent 按 ip 屏蔽, 同一 ip 只需提交一次
+        self.pending = {}
+        self.received = 0
+        self.last_flush = time.monotonic()
+        # 多个实例的线程会同时放入
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, peers: dict[str, dict]):
+        """
+        :param peers: {ip:port: peer}
+        """
+        with self.lock:
+            for key, peer in peers.items():
+                self.received += 1
+                self.pending.setdefault(key.rsplit(":", 1)[0], (key, peer))
+
+    def due(self) -> bool:
+        return bool(self.pending) and (
+            len(self.pending) >= self.batch_size
+            or time.monotonic() - self.last_flush >= self.interval
+        )
+
+    def maybe_flush(self) -> int:
+        if self.due():
+            return self.flush()
+        return 0
+
+    def flush(self) -> int:
+        """
+        :return: 本次提交的 peer 数量
+        """
+        self.last_flush = time.monotonic()
+        with self.lock:
+            if not self.pending:
+                return 0
+            pending, self.pending = self.pending, {}
+            received, self.received = self.received, 0
+        peers = [key for key, _ in pending.values()]
+        try:
+            res = ban_peers(self.url, peers, session=self.session)
+            if res.status_code != 200:
+                raise requests.HTTPError(
+                    f"banPeers returned {res.status_code}", response=res
+                )
+        except requests.RequestException as e:
+            log.error("ban peers failed, will retry: %r", e)
+            with self.lock:
+                for ip, peer in pending.items():
+                    self.pending.setdefault(ip, peer)
+                self.received += received
+            return 0
+        if self.ban_cache is not None:
+            for _, peer in pending.values():
+                self.ban_cache.add(peer)
+        coalesced = received - len(peers)
+        metrics.inc("ban_requests_total")
+        metrics.inc("bans_coalesced_total", coalesced)
+        log.info(
+            "banned %d peers in one request, %d duplicates coalesced",
+            len(peers), coalesced
+        )
+        return len(peers)
+
+
+class PeerHistory(object):
+    """
+    每个 peer 最近 window 次轮询的 uploaded/downloaded, 保存在预先分配的
+    环形数组中, 用于计算一段时间内的平均速度。
+    最多跟踪 capacity 个 peer, 超出时淘汰最久未更新的 peer, 内存占用固定。
+    """
+
+    def __init__(self, capacity: int = 65536, window: int = 8):
+        self.capacity = capacity
+        self.window = window
+        self.times = array("d", bytes(8 * capacity * window))
+        self.uploaded = array("d", bytes(8 * capacity * window))
+        self.downloaded = array("d", bytes(8 * capacity * window))
+        # 每个 slot 下一次写入的位置和已有的样本数
+        self.head = array("I", bytes(4 * capacity))
+        self.count = array("I", bytes(4 * capacity))
+        # key -> slot, 按最近更新排序
+        self.slots = OrderedDict()
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def slot(self, key) -> int:
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.slots.move_to_end(key)
+            return slot
+        if self.free:
+            slot = self.free.pop()
+        else:
+            _, slot = self.slots.popitem(last=False)
+        self.head[slot] = 0
+        self.count[slot] = 0
+        self.slots[key] = slot
+        return slot
+
+    def record(self, key, uploaded, downloaded, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        slot = self.slot(key)
+        head = self.head[slot]
+        i = slot * self.window + head
+        self.times[i] = now
+        self.uploaded[i] = uploaded
+        self.downloaded[i] = downloaded
+        self.head[slot] = (head + 1) % self.window
+        if self.count[slot] < self.window:
+            self.count[slot] += 1
+
+    def rates(self, key):
+        """
+        :return: 窗口内的平均 (上传速度, 下载速度), 样本不足时为 None
+        """
+        slot = self.slots.get(key)
+        if slot is None or self.count[slot] < 2:
+            return None
+        base = slot * self.window
+        newest = base + (self.head[slot] - 1) % self.window
+        oldest = base + (self.head[slot] - self.count[slot]) % self.window
+        elapsed = self.times[newest] - self.times[oldest]
+        if elapsed <= 0:
+            return None
+        return (
+            (self.uploaded[newest] - self.uploaded[oldest]) / elapsed,
+            (self.downloaded[newest] - self.downloaded[oldest]) / elapsed,
+        )
+
+    def forget(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            self.free.append(slot)
+
+    def update(self, torrent_hash, peers: dict, now: float = None):
+        """
+        记录 peer 的样本, 并把平均速度写入 avg_up_speed 和 avg_dl_speed,
+        样本不足时使用当前速度。
+        """
+        if now is None:
+            now = time.monotonic()
+        for key, peer in peers.items():
+            history_key = f"{torrent_hash}/{key}"
+            self.record(history_key, peer["uploaded"], peer["downloaded"], now)
+            rates = self.rates(history_key)
+            if rates is None:
+                peer["avg_up_speed"] = peer["up_speed"]
+                peer["avg_dl_speed"] = peer["dl_speed"]
+            else:
+                peer["avg_up_speed"], peer["avg_dl_speed"] = rates
+
+
+class PollScheduler(object):
+    """
+    按 torrent 的活跃程度安排轮询:
+    正在下载或 peer 变化数达到 churn_threshold 的 torrent
+    每 min_interval 秒轮询一次, 空闲的 torrent 每次轮询后间隔乘以 backoff,
+    最长为 max_interval。
+    所有 WebUI 请求共用每秒 rate 次的令牌桶, rate 为 None 时不限制。
+    """
+
+    busy_states = ("downloading", "forceddl")
+
+    def __init__(
+        self, min_interval: float = 1, max_interval: float = 300,
+        backoff: float = 2, rate: float = None, churn_threshold: int = 1
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.rate = rate
+        self.churn_threshold = churn_threshold
+        # 多个实例平分 rate 后可能小于 1, 令牌桶至少能存下一个令牌
+        self.capacity = rate and max(rate, 1)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        # hash -> 当前轮询间隔, 下一次轮询的时间
+        self.intervals = {}
+        self.next_poll = {}
+
+    def refill(self, now):
+        if self.rate is None:
+            return
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def take(self, count: int, now: float = None) -> int:
+        """
+        :return: 实际可以发出的请求数
+        """
+        if self.rate is None:
+            return count
+        self.refill(time.monotonic() if now is None else now)
+        count = min(count, int(self.tokens))
+        self.tokens -= count
+        return count
+
+    def due(self, torrents: list[dict], now: float = None) -> list[dict]:
+        """
+        :return: 到了轮询时间的 torrent, 最久未轮询的在前, 数量受令牌限制
+        """
+        if now is None:
+            now = time.monotonic()
+        hashes = {torrent["hash"] for torrent in torrents}
+        for hash_id in list(self.next_poll):
+            if hash_id not in hashes:
+                del self.next_poll[hash_id]
+                self.intervals.pop(hash_id, None)
+        ready = sorted(
+            (
+                torrent for torrent in torrents
+                if self.next_poll.get(torrent["hash"], 0) <= now
+            ),
+            key=lambda torrent: self.next_poll.get(torrent["hash"], 0),
+        )
+        return ready[:self.take(len(ready), now)]
+
+    def update(self, torrent, churn: int, now: float = None):
+        """
+        :param churn: 本次轮询中新增或变化的 peer 数量
+        """
+        if now is None:
+            now = time.monotonic()
+        hash_id = torrent["hash"]
+        if torrent["state"].lower() in self.busy_states \
+                or churn >= self.churn_threshold:
+            interval = self.min_interval
+        else:
+            interval = min(
+                self.max_interval,
+                self.intervals.get(hash_id, self.min_interval) * self.backoff
+            )
+        self.intervals[hash_id] = interval
+        self.next_poll[hash_id] = now + interval
+
+    def token_wait(self) -> float:
+        """
+        :return: 距离令牌桶中有一个令牌的秒数
+        """
+        if self.rate is None or self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def wait_time(self, now: float = None) -> float:
+        """
+        :return: 距离下一个 torrent 需要轮询的秒数, 最长为 min_interval
+        """
+        if now is None:
+            now = time.monotonic()
+        wait = self.min_interval
+        if self.next_poll:
+            wait = min(wait, min(self.next_poll.values()) - now)
+        return max(wait, self.token_wait(), 0)
+
+
+class Recorder(object):
+    """
+    按时间顺序把 WebUI 的响应保存为 JSON lines,
+    用 qB_ban_replay.py 回放, 不需要运行 qBittorrent 就可以测试屏蔽规则。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, url, params: dict, data):
+        entry = {
+            "time": round(time.monotonic() - self.start, 3),
+            "endpoint": urlsplit(url).path,
+            "params": params,
+            "data": data,
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class SyncClient(object):
+    """
+    保存每个 sync 接口返回的 rid, 并把 full_update/增量数据合并到内存模型中,
+    每次轮询只需下载变化的部分。
+    """
+
+    def __init__(
+        self, root_url, session: requests.Session = None,
+        recorder: Recorder = None
+    ):
+        self.session = session or requests
+        self.recorder = recorder
+        self.maindata_url = root_url + '/api/v2/sync/maindata'
+        self.peers_url = root_url + '/api/v2/sync/torrentPeers'
+        self.maindata_rid = 0
+        self.peers_rid = {}
+        self.torrents = {}
+        # 上一次 maindata 中每个 torrent 有变化的字段
+        self.changed_fields = {}
+        self.peers = {}
+
+    def sync_torrents(self) -> dict[str, dict]:
+        """
+        :return: 新增或有变化的 torrent, 完整的列表在 self.torrents
+        """
+        data = self.get_json(self.maindata_url, {'rid': self.maindata_rid})
+        if data is None:
+            return {}
+        return self.apply_maindata(data)
+
+    def sync_peers(self, hash_id) -> dict[str, dict]:
+        """
+        :return: 该 torrent 新增或有变化的 peer,
+                 完整的列表在 self.peers[hash_id]
+        """
+        content = {'rid': self.peers_rid.get(hash_id, 0), 'hash': hash_id}
+        data = self.get_json(self.peers_url, content)
+        if data is None:
+            return {}
+        return self.apply_peers(hash_id, data)
+
+    def get_json(self, url, params: dict):
+        res = self.session.get(url, params=params)
+        if res.status_code != 200:
+            return None
+        data = json.loads(res.text)
+        if self.recorder is not None:
+            self.recorder.write(url, params, data)
+        return data
+
+    def apply_maindata(self, data: dict) -> dict[str, dict]:
+        self.maindata_rid = data.get('rid', 0)
+        if data.get('full_update'):
+            self.torrents = {}
+        for hash_id in data.get('torrents_removed', ()):
+            self.torrents.pop(hash_id, None)
+            self.peers.pop(hash_id, None)
+            self.peers_rid.pop(hash_id, None)
+        changed = {}
+        self.changed_fields = {}
+        for hash_id, fields in data.get('torrents', {}).items():
+            torrent = self.torrents.setdefault(hash_id, {'hash': hash_id})
+            torrent.update(fields)
+            changed[hash_id] = torrent
+            self.changed_fields[hash_id] = set(fields)
+        return changed
+
+    def apply_peers(self, hash_id, data: dict) -> dict[str, dict]:
+        self.peers_rid[hash_id] = data.get('rid', 0)
+        if data.get('full_update'):
+            model = self.peers[hash_id] = {}
+        else:
+            model = self.peers.setdefault(hash_id, {})
+        for key in data.get('peers_removed', ()):
+            model.pop(key, None)
+        changed = {}
+        for key, fields in data.get('peers', {}).items():
+            peer = model.setdefault(key, {})
+            peer.update(fields)
+            changed[key] = peer
+        return changed
+
+
+class AsyncSyncClient(SyncClient):
+    """
+    基于 aiohttp 的 SyncClient, 用有限的连接数并发获取多个 torrent 的 peer。
+    """
+
+    def __init__(
+        self, root_url, session: requests.Session = None,
+        max_connections=16, recorder: Recorder = None
+    ):
+        super().__init__(root_url, session=session, recorder=recorder)
+        self.max_connections = max_connections
+        self.client = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        # 沿用 WebUISession 登录后的 SID cookie
+        cookies = None
+        if isinstance(self.session, requests.Session):
+            cookies = self.session.cookies.get_dict()
+        self.client = aiohttp.ClientSession(
+            connector=connector, cookies=cookies
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.client.close()
+        self.client = None
+
+    async def _get_json(self, url, params):
+        endpoint = urlsplit(url).path
+        try:
+            with metrics.time("webui_request_seconds", endpoint=endpoint):
+                async with self.client.get(url, params=params) as res:
+                    if res.status == 200:
+                        data = await res.json(content_type=None)
+                        if self.recorder is not None:
+                            self.recorder.write(url, params, data)
+                        return data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error("%s: %r", url, e)
+        metrics.inc("webui_errors_total", endpoint=endpoint)
+        return None
+
+    async def async_sync_torrents(self) -> dict[str, dict]:
+        data = await self._get_json(
+            self.maindata_url, {'rid': self.maindata_rid}
+        )
+        if data is None:
+            return {}
+        return self.apply_maindata(data)
+
+    async def async_sync_peers(self, hash_id) -> dict[str, dict]:
+        content = {'rid': self.peers_rid.get(hash_id, 0), 'hash': hash_id}
+        data = await self._get_json(self.peers_url, content)
+        if data is None:
+            return {}
+        return self.apply_peers(hash_id, data)
+
+    async def async_sync_peers_many(self, hash_ids) -> dict[str, dict]:
+        """
+        :return: {hash_id: 新增或有变化的 peer}
+        """
+        results = await asyncio.gather(
+            *(self.async_sync_peers(hash_id) for hash_id in hash_ids)
+        )
+        return dict(zip(hash_ids, results))
+
+
+POLICY_STATES = {
+    "downloading": ("downloading", "forceddl"),
+    "uploading": ("uploading", "forcedup"),
+}
+NUMERIC_OPS = {
+    "<": operator.lt, "<=": operator.le, ">": operator.gt,
+    ">=": operator.ge, "==": operator.eq, "!=": operator.ne,
+}
+# 数值比较的开销为 1, 按开销从小到大检查规则
+OP_COSTS = {
+    "in": 2, "not_in": 2, "contains": 3, "in_range": 3, "match": 4,
+}
+DEFAULT_RULES = {
+    "downloading": {
+        "and": [
+            {"field": "uploaded", "op": ">=", "value": 0.01, "per": "size"},
+            {"field": "downloaded", "op": "<", "value": 0.01, "per": "size"},
+            {"field": "dl_speed", "op": "<", "value": 0.8 * 1024},
+            {"field": "up_speed", "op": ">", "value": 8 * 1024},
+            {"field": "relevance", "op": ">=", "value": 0.02},
+            {
+                "field": "client", "op": "match",
+                "value": r'(?i)-xl0012|xunlei|xfplay|qqdownload|7\.',
+            },
+        ],
+        "or": [],
+    },
+    "uploading": {
+        "and": [
+            {
+                "field": "client", "op": "match",
+                "value": r'(?i)-xl0012|xunlei|xfplay|qqdownload|7\.',
+            },
+        ],
+        "or": [],
+    },
+}
+
+
+class IPRanges(object):
+    """
+    按起始地址排序且互不重叠的 IP 区间, 用 bisect 在 O(log n) 内查找。
+    每条记录为定长的大端字节 (IPv4 为 4+4 字节, IPv6 为 16+16 字节),
+    字节序与数值大小一致, 可以直接比较, 不需要转换成 int。
+    """
+    magic = b"QBIPIDX1"
+    # magic, IPv4 区间数, IPv6 区间数, 源文件的 mtime_ns 和大小
+    header = struct.Struct("<8sQQqQ")
+
+    def __init__(self, v4: bytes = b"", v6: bytes = b"", buffer=None):
+        self.buffer = buffer
+        self.v4 = _RangeRecords(v4, 4)
+        self.v6 = _RangeRecords(v6, 16)
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6)
+
+    def __contains__(self, ip: str) -> bool:
+        try:
+            return self.v4.find(socket.inet_pton(socket.AF_INET, ip))
+        except OSError:
+            pass
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+        except OSError:
+            return False
+        if packed.startswith(IPV4_MAPPED):
+            return self.v4.find(packed[12:])
+        return self.v6.find(packed)
+
+    @classmethod
+    def parse(cls, lines) -> "IPRanges":
+        """
+        支持以下格式, 空行和 #, // 开头的行会被忽略:
+          ipfilter.dat: 1.2.3.0 - 1.2.3.255 , 000 , 描述, 等级大于 127 的不屏蔽
+          P2P: 描述:1.2.3.0-1.2.3.255
+          CIDR: 1.2.3.0/24, 2001:db8::/32
+          单个地址: 1.2.3.4
+        """
+        ranges = {4: [], 6: []}
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(("#", "//")):
+                continue
+            try:
+                start, end = cls.parse_line(line)
+            except ValueError:
+                log.debug("ignore ip range: %r", line)
+                continue
+            if start is None:
+                continue
+            ranges[start[0]].append((start[1], end[1]))
+        return cls(cls.merge(ranges[4], 4), cls.merge(ranges[6], 16))
+
+    @staticmethod
+    def parse_line(line):
+        # P2P 格式的名称中可能有逗号, 要在 ipfilter.dat 格式之前匹配
+        match = P2P_LINE.match(line)
+        if match:
+            line = match.group(1)
+        elif "," in line:
+            fields = [f.strip() for f in line.split(",")]
+            if len(fields) > 1 and fields[1] and int(fields[1]) > 127:
+                return None, None
+            line = fields[0]
+        elif "/" in line:
+            network = ipaddress.ip_network(line, strict=False)
+            return (
+                (network.version, int(network.network_address)),
+                (network.version, int(network.broadcast_address)),
+            )
+        start, sep, end = line.partition("-")
+        start = _ip_address(start)
+        end = _ip_address(end) if sep else start
+        if start[0] != end[0] or end[1] < start[1]:
+            raise ValueError(line)
+        return start, end
+
+    @staticmethod
+    def merge(ranges, width: int) -> bytes:
+        """
+        合并重叠和相邻的区间, 返回连续存放的定长记录
+        """
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        return b"".join(
+            start.to_bytes(width, "big") + end.to_bytes(width, "big")
+            for start, end in merged
+        )
+
+    @classmethod
+    def load(cls, path, cache_path=None) -> "IPRanges":
+        """
+        读取屏蔽列表, 解析结果保存到 cache_path (默认为 path.idx),
+        源文件没有变化时直接 mmap 缓存文件, 不再解析。
+        """
+        path = Path(path)
+        cache_path = Path(cache_path or path.with_name(path.name + ".idx"))
+        stat = path.stat()
+        try:
+            ranges = cls.mmap(cache_path, stat.st_mtime_ns, stat.st_size)
+        except (OSError, ValueError) as e:
+            log.debug("ip range cache %s unavailable: %r", cache_path, e)
+        else:
+            log.info(f"loaded {len(ranges)} ip ranges from {cache_path}")
+            return ranges
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            ranges = cls.parse(f)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(cls.header.pack(
+                    cls.magic, len(ranges.v4), len(ranges.v6),
+                    stat.st_mtime_ns, stat.st_size,
+                ))
+                f.write(ranges.v4.buffer)
+                f.write(ranges.v6.buffer)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            log.error(f"save ip range cache {cache_path} failed: {e!r}")
+        log.info(f"loaded {len(ranges)} ip ranges from {path}")
+        return ranges
+
+    @classmethod
+    def mmap(cls, cache_path, mtime_ns: int, size: int) -> "IPRanges":
+        with open(cache_path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < cls.header.size:
+            buffer.close()
+            raise ValueError("truncated cache")
+        magic, n4, n6, _mtime_ns, _size = cls.header.unpack_from(buffer)
+        if (magic, _mtime_ns, _size) != (cls.magic, mtime_ns, size):
+            buffer.close()
+            raise ValueError("stale cache")
+        if len(buffer) != cls.header.size + n4 * 8 + n6 * 32:
+            buffer.close()
+            raise ValueError("truncated cache")
+        view = memoryview(buffer)
+        v4 = view[cls.header.size:cls.header.size + n4 * 8]
+        v6 = view[cls.header.size + n4 * 8:]
+        return cls(v4, v6, buffer=buffer)
+
+
+class _RangeRecords(object):
+    """
+    定长记录的起始地址序列, 供 bisect 使用
+    """
+
+    def __init__(self, buffer, width: int):
+        self.buffer = buffer
+        self.width = width
+        self.size = width * 2
+
+    def __len__(self):
+        return len(self.buffer) // self.size
+
+    def __getitem__(self, i):
+        offset = i * self.size
+        return bytes(self.buffer[offset:offset + self.width])
+
+    def find(self, packed: bytes) -> bool:
+        i = bisect.bisect_right(self, packed) - 1
+        if i < 0:
+            return False
+        offset = i * self.size + self.width
+        return packed <= bytes(self.buffer[offset:offset + self.width])
+
+
+P2P_LINE = re.compile(r"^.*:\s*([0-9.]+\s*-\s*[0-9.]+)$")
+IPV4_MAPPED = bytes(10) + b"\xff\xff"
+
+
+def _ip_address(text: str) -> tuple[int, int]:
+    """
+    ipfilter.dat 中的 IPv4 地址常带有前导零, 如 001.002.003.004,
+    ipaddress 不接受这种写法, 并且逐个解析几百万行太慢, 所以手动解析。
+    :return: (版本, 地址的整数值)
+    """
+    text = text.strip()
+    if ":" in text:
+        return 6, int(ipaddress.IPv6Address(text))
+    parts = text.split(".")
+    if len(parts) != 4:
+        raise ValueError(text)
+    value = 0
+    for part in parts:
+        octet = int(part)
+        if not 0 <= octet <= 255:
+            raise ValueError(text)
+        value = value << 8 | octet
+    return 4, value
+
+
+@functools.lru_cache(maxsize=None)
+def load_ip_ranges(path) -> IPRanges:
+    """
+    同一个文件被多条规则引用时只加载一次
+    """
+    return IPRanges.load(Path(__file__).parent / path)
+
+
+class Predicate(object):
+    """
+    编译后的一条规则: peer[field] op value,
+    指定 per 时阈值为 value * torrent[per]。
+    """
+
+    def __init__(self, field: str, op: str, value, per: str = None):
+        self.field = field
+        self.op = op
+        self.per = per
+        self.name = f"{field} {op} {value!r}" + (f" * {per}" if per else "")
+        self.numeric = op in NUMERIC_OPS
+        if self.numeric:
+            self.value = float(value)
+            self.test = NUMERIC_OPS[op]
+            self.cost = 1
+            return
+        if op not in OP_COSTS:
+            raise ValueError(f"unknown op: {op}")
+        if per:
+            raise ValueError(f"{self.name}: per only works with numeric op")
+        self.value = value
+        self.cost = OP_COSTS[op]
+        if op == "match":
+            regex = re.compile(value)
+            self.test = functools.lru_cache(maxsize=4096)(
+                lambda v: bool(regex.match(v))
+            )
+        elif op == "contains":
+            self.test = lambda v: value in v
+        elif op == "in_range":
+            if isinstance(value, str):
+                ranges = load_ip_ranges(value)
+            elif isinstance(value, (list, tuple)):
+                ranges = IPRanges.parse(value)
+            else:
+                raise ValueError(
+                    f"{self.name}: value must be a file or a list"
+                )
+            self.test = functools.lru_cache(maxsize=4096)(
+                ranges.__contains__
+            )
+        else:
+            if not isinstance(value, (list, tuple, set)):
+                raise ValueError(f"{self.name}: value must be a list")
+            values = frozenset(value)
+            if op == "in":
+                self.test = lambda v: v in values
+            else:
+                self.test = lambda v: v not in values
+
+    def __repr__(self):
+        return f"<Predicate {self.name}>"
+
+    def threshold(self, torrent):
+        if self.per:
+            return self.value * torrent[self.per]
+        return self.value
+
+    def __call__(self, peer, torrent) -> bool:
+        # 旧版本的 qBittorrent 可能没有这个字段, 视为不匹配
+        value = peer.get(self.field)
+        if value is None:
+            return False
+        if self.numeric:
+            return self.test(value, self.threshold(torrent))
+        return self.test(value)
+
+    def mask(self, columns, torrent, rows):
+        """
+        :param rows: 只检查这些行
+        :return: 与 rows 等长的布尔数组
+        """
+        if self.numeric:
+            column = columns[self.field][rows]
+            # 缺少的字段为 NaN, 除 != 之外的比较结果都是 False
+            return self.test(column, self.threshold(torrent)) \
+                & ~np.isnan(column)
+        return columns.map(self.field, self.test, rows)
+
+
+def compile_rules(conf: dict) -> dict[str, dict[str, list[Predicate]]]:
+    """
+    把规则配置编译成按开销排序的 Predicate 列表,
+    只在启动时编译一次。
+    """
+    rules = {}
+    for group, policy in conf.items():
+        if group not in POLICY_STATES:
+            raise ValueError(
+                f"unknown rule group: {group}, "
+                f"must be one of {list(POLICY_STATES)}"
+            )
+        if set(policy) - {"and", "or"}:
+            raise ValueError(f"{group}: only 'and' and 'or' are allowed")
+        rules[group] = {}
+        for join in ("and", "or"):
+            predicates = []
+            for rule in policy.get(join) or ():
+                try:
+                    predicates.append(Predicate(**rule))
+                except TypeError as e:
+                    raise ValueError(f"{group}.{join}: {rule}: {e}")
+            rules[group][join] = sorted(predicates, key=lambda p: p.cost)
+    return rules
+
+
+def load_conf(conf_path) -> dict:
+    if yaml is None:
+        raise RuntimeError(f"读取 {conf_path} 需要安装 PyYAML。")
+    with open(conf_path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
 
 
 class BanPeerPolicy(object):
-    ban_clients = re.compile(r'(?i)-xl0012|xunlei|xfplay|qqdownload|7\.')
+    rules = compile_rules(DEFAULT_RULES)
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, rules: dict = None):
         self.torrent = torrent
-        self.min_uploaded = 0.01
-        self.min_downloaded = 0.01
-        self.min_relevance = 0.02
-        self.min_download_speed = 0.8 * 1024
-        self.max_upload_speed = 8 * 1024
-        self.download_policy = {
-            "and": [
-                self.check_uploaded,
-                self.check_downloaded,
-                self.check_download_speed,
-                self.check_upload_speed,
-                self.check_relevance,
-                self.check_client,
-            ],
-            "or": []
-        }
-        self.upload_policy = {
-            "and": [
-                self.check_client,
-            ],
-            "or": [],
+        if rules is None:
+            rules = self.rules
+        self.group = None
+        self.policy = {"and": [], "or": []}
+        state = self.torrent["state"].lower()
+        for group, states in POLICY_STATES.items():
+            if state in states and group in rules:
+                self.group = group
+                self.policy = rules[group]
+
+    def match(self, peer) -> bool:
+        """
+        逐个检查, 开销小的规则先检查, 结果确定后不再检查其余规则。
+        """
+        return bool(
+            self.policy["and"]
+            and all(p(peer, self.torrent) for p in self.policy["and"])
+            or any(p(peer, self.torrent) for p in self.policy["or"])
+        )
+
+    def evaluate(self, peers: dict) -> list[str]:
+        """
+        批量检查一个 torrent 的所有 peer, 把 peer 转换成按字段存储的数组,
+        每条规则只对仍未确定的行做一次向量化比较。没有安装 numpy 时逐个检查。
+        :return: 需要屏蔽的 peer 的 key
+        """
+        if not peers:
+            return []
+        if np is None:
+            return [key for key, peer in peers.items() if self.match(peer)]
+        keys = list(peers)
+        columns = PeerColumns(list(peers.values()))
+        banned = np.zeros(len(keys), dtype=bool)
+        if self.policy["and"]:
+            rows = np.arange(len(keys))
+            for predicate in self.policy["and"]:
+                rows = rows[predicate.mask(columns, self.torrent, rows)]
+                if not rows.size:
+                    break
+            banned[rows] = True
+        for predicate in self.policy["or"]:
+            rows = np.flatnonzero(~banned)
+            if not rows.size:
+                break
+            banned[rows[predicate.mask(columns, self.torrent, rows)]] = True
+        return [keys[i] for i in np.flatnonzero(banned)]
+
+
+class PeerColumns(object):
+    """
+    按字段存储的 peer 表, 每个字段在第一次使用时才转换成 numpy 数组。
+    """
+
+    def __init__(self, peers: list[dict]):
+        self.peers = peers
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __getitem__(self, field):
+        column = self.columns.get(field)
+        if column is None:
+            column = self.columns[field] = np.fromiter(
+                (
+                    np.nan if peer.get(field) is None else peer[field]
+                    for peer in self.peers
+                ),
+                dtype=np.float64, count=len(self.peers),
+            )
+        return column
+
+    def map(self, field, func, rows):
+        """
+        对 rows 中非数值字段逐个调用 func, 相同的值只计算一次,
+        缺少的字段不调用 func, 视为不匹配。
+        """
+        cache = {None: False}
+        peers = self.peers
+        return np.fromiter(
+            (
+                cache[value] if value in cache
+                else cache.setdefault(value, func(value))
+                for value in (peers[i].get(field) for i in rows)
+            ),
+            dtype=bool, count=len(rows),
+        )
+
+
+ACTIVE_STATES = ("uploading", "downloading", "forcedup", "forceddl")
+# 事件模式下, 这些字段变化时才获取 torrent 的 peer
+EVENT_FIELDS = frozenset(("num_leechs", "dlspeed", "upspeed"))
+
+
+def active_torrents(torrents: dict) -> list[dict]:
+    return [
+        torrent for torrent in list(torrents.values())
+        if torrent["state"].lower() in ACTIVE_STATES
+    ]
+
+
+def detect_leeches(
+    torrent, peers: dict, ban_cache: BanCache = None,
+    history: PeerHistory = None
+) -> dict[str, dict]:
+    """
+    :param ban_cache: 跳过已经屏蔽过的 peer, 提交成功后由 BanQueue 记录
+    :param history: 记录 peer 的样本, 为规则提供 avg_up_speed/avg_dl_speed
+    :return: 需要屏蔽的 peer, {ip:port: peer}
+    """
+    if ban_cache is not None:
+        peers = {
+            key: peer for key, peer in peers.items() if peer not in ban_cache
         }
-        if self.torrent["state"].lower() in ("downloading", "forceddl"):
-            self.policy = self.download_policy
-        elif self.torrent["state"].lower() in ("uploading", "forcedup"):
-            self.policy = self.upload_policy
+    if history is not None:
+        history.update(torrent["hash"], peers)
+    ban_policy = BanPeerPolicy(torrent=torrent)
+    # 关闭 DEBUG 时不格式化任何 torrent 和 peer 的字段
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("torrent name: %s", torrent['name'])
+        log.debug("torrent params:\n%s", pformat(torrent))
+        for peer in peers.values():
+            log.debug("peer ip: %s", peer["ip"])
+            log.debug("peer params:\n%s", pformat(peer))
+    metrics.inc("peers_evaluated_total", len(peers))
+    with metrics.time("policy_seconds"):
+        banned = ban_policy.evaluate(peers)
+    leeches = {}
+    for key in banned:
+        peer = peers[key]
+        and_res = {p.name: p(peer, torrent) for p in ban_policy.policy["and"]}
+        or_res = {p.name: p(peer, torrent) for p in ban_policy.policy["or"]}
+        if and_res and all(and_res.values()):
+            metrics.inc("bans_total", group=ban_policy.group, rule="and")
+        for name, res in or_res.items():
+            if res:
+                metrics.inc("bans_total", group=ban_policy.group, rule=name)
+        log.info("=" * 80)
+        log.info("and_res: %s", and_res)
+        log.info("or_res: %s", or_res)
+        log.info(
+            "leeches were detected in this torrent: %s(%s)",
+            torrent['name'], torrent['progress']
+        )
+        if log.isEnabledFor(logging.INFO):
+            log.info("will be banned:\n%s", "\n".join(
+                f"{_key}: {_value}" for _key, _value in peer.items()
+            ))
+        audit_log.info("ban", extra={"audit": {
+            "torrent": torrent["name"],
+            "hash": torrent["hash"],
+            "group": ban_policy.group,
+            "peer": f"{peer['ip']}:{peer['port']}",
+            "client": peer.get("client"),
+            "country_code": peer.get("country_code"),
+            "progress": peer.get("progress"),
+            "uploaded": peer.get("uploaded"),
+            "downloaded": peer.get("downloaded"),
+            "and": and_res,
+            "or": or_res,
+        }})
+        leeches[f"{peer['ip']}:{peer['port']}"] = peer
+    return leeches
+
+
+class TrackerRefresher(object):
+    """
+    在后台定期下载 tracker 列表, 请求时带上 ETag/If-Modified-Since,
+    列表保存在本地缓存中, 只有列表变化时才写入各实例的 add_trackers。
+    """
+
+    headers = {
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+                  'image/webp,image/apng,*/*;q=0.8,'
+                  'application/signed-exchange;v=b3 ',
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                      'AppleWebKit/537.36 (KHTML, like Gecko) '
+                      'Chrome/108.0.5359.125 Safari/537.36 ',
+        'Accept-Encoding': 'gzip, deflate',
+    }
+
+    def __init__(
+        self, url, cache_path, interval: float = 6 * 3600,
+        proxies: dict = None, timeout: float = 10
+    ):
+        self.url = url
+        self.cache_path = Path(cache_path)
+        self.meta_path = self.cache_path.with_name(
+            self.cache_path.name + ".json"
+        )
+        self.interval = interval
+        self.proxies = proxies
+        self.timeout = timeout
+        self.trackers = None
+        self.etag = None
+        self.last_modified = None
+        # 实例名 -> 已经写入的 tracker 列表
+        self.applied = {}
+        self.load()
+
+    def load(self):
+        try:
+            self.trackers = self.cache_path.read_text(encoding="utf-8")
+            meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        self.etag = meta.get("etag")
+        self.last_modified = meta.get("last_modified")
+
+    def save(self):
+        for path, text in (
+            (self.cache_path, self.trackers),
+            (self.meta_path, json.dumps({
+                "etag": self.etag, "last_modified": self.last_modified,
+            })),
+        ):
+            tmp_path = path.with_name(path.name + ".tmp")
+            tmp_path.write_text(text, encoding="utf-8")
+            os.replace(tmp_path, path)
+
+    def fetch(self) -> bool:
+        """
+        :return: tracker 列表是否有变化
+        """
+        headers = dict(self.headers)
+        if self.trackers is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+        res = requests.get(
+            self.url, proxies=self.proxies, headers=headers,
+            timeout=self.timeout,
+        )
+        if res.status_code == 304:
+            log.info('tracker服务器列表没有变化。')
+            return False
+        if res.status_code != 200:
+            log.error('加载tracker服务器列表失败: %s', res.status_code)
+            return False
+        changed = res.text != self.trackers
+        self.trackers = res.text
+        self.etag = res.headers.get("ETag")
+        self.last_modified = res.headers.get("Last-Modified")
+        self.save()
+        log.info('加载tracker服务器列表成功, %s。', '有变化' if changed else '没有变化')
+        return changed
+
+    def apply(self, instance):
+        preferences = instance.session.get(
+            instance.root_url + '/api/v2/app/preferences'
+        ).json()
+        if self.trackers != preferences.get("add_trackers"):
+            _params = {
+                'add_trackers_enabled': True, 'add_trackers': self.trackers,
+            }
+            instance.session.post(
+                instance.root_url + '/api/v2/app/setPreferences',
+                data={'json': json.dumps(_params)},
+            )
+            log.info('%s: 已更新tracker服务器列表。', instance.name)
+        self.applied[instance.name] = self.trackers
+
+    def refresh(self, instances: list):
+        try:
+            self.fetch()
+        except requests.RequestException as e:
+            log.error('加载tracker服务器列表失败: %r', e)
+        if not self.trackers:
+            return
+        for instance in instances:
+            if self.applied.get(instance.name) == self.trackers:
+                continue
+            try:
+                self.apply(instance)
+            except (requests.RequestException, ValueError) as e:
+                log.error('%s: 更新tracker服务器列表失败: %r', instance.name, e)
+
+    def run(self, instances: list):
+        while 1:
+            self.refresh(instances)
+            time.sleep(self.interval)
+
+    def start(self, instances: list) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.run, args=(instances,), name="trackers", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+class BanCoordinator(object):
+    """
+    多个 qBittorrent 实例共享的屏蔽记录:
+    任意一个实例检测到的 leech 会放入所有实例的 BanQueue,
+    由每个实例用自己的会话批量提交。
+    """
+
+    def __init__(self, ban_cache: BanCache):
+        self.ban_cache = ban_cache
+        self.queues = []
+
+    def register(self, ban_queue: BanQueue):
+        self.queues.append(ban_queue)
+
+    def put(self, peers: dict[str, dict]):
+        if peers:
+            for ban_queue in self.queues:
+                ban_queue.put(peers)
+
+
+class Instance(object):
+    """
+    一个 qBittorrent WebUI, 有自己的会话, 轮询状态和 BanQueue。
+    """
+
+    def __init__(
+        self, name, root_url, coordinator: BanCoordinator,
+        session: WebUISession = None, scheduler: PollScheduler = None,
+        history: PeerHistory = None, recorder: Recorder = None,
+        ban_interval: float = 1, ban_batch_size: int = 100,
+        event_mode: bool = False
+    ):
+        """
+        :param event_mode: 不按 torrent 轮询, 只获取 maindata 中
+                           EVENT_FIELDS 有变化的 torrent 的 peer
+        """
+        self.name = name
+        self.root_url = root_url
+        self.coordinator = coordinator
+        self.session = session or WebUISession(root_url)
+        self.scheduler = scheduler or PollScheduler()
+        self.history = history or PeerHistory()
+        self.recorder = recorder
+        self.ban_queue = BanQueue(
+            root_url + '/api/v2/transfer/banPeers', interval=ban_interval,
+            batch_size=ban_batch_size, session=self.session,
+            ban_cache=coordinator.ban_cache,
+        )
+        coordinator.register(self.ban_queue)
+        self.sync = SyncClient(
+            root_url, session=self.session, recorder=recorder
+        )
+        self.next_maindata = 0
+        self.event_mode = event_mode
+        # 事件模式下等待获取 peer 的 torrent, 令牌不足时留到下一次
+        self.pending = {}
 
-    def check_uploaded(self, peer):
-        log.debug(f"{peer['ip']}.uploaded: {peer['uploaded']}")
-        return peer["uploaded"] / self.torrent["size"] >= \
-            self.min_uploaded
+    def due_torrents(self, changed: dict) -> list[dict]:
+        """
+        :param changed: 本次 maindata 中有变化的 torrent
+        """
+        if not self.event_mode:
+            return self.scheduler.due(active_torrents(self.sync.torrents))
+        for hash_id, torrent in changed.items():
+            if self.sync.changed_fields[hash_id] & EVENT_FIELDS:
+                self.pending[hash_id] = torrent
+        for hash_id in list(self.pending):
+            torrent = self.sync.torrents.get(hash_id)
+            if torrent is None \
+                    or torrent["state"].lower() not in ACTIVE_STATES:
+                del self.pending[hash_id]
+            else:
+                self.pending[hash_id] = torrent
+        torrents = list(self.pending.values())
+        torrents = torrents[:self.scheduler.take(len(torrents))]
+        for torrent in torrents:
+            del self.pending[torrent["hash"]]
+        return torrents
 
-    def check_downloaded(self, peer):
-        log.debug(f"{peer['ip']}.downloaded: {peer['downloaded']}")
-        return peer["downloaded"] / self.torrent["size"] < \
-            self.min_downloaded
+    def check(self, torrent, peers: dict):
+        # 事件模式不按 torrent 安排轮询时间
+        if not self.event_mode:
+            self.scheduler.update(torrent, len(peers))
+        self.coordinator.put(
+            detect_leeches(
+                torrent, peers, self.coordinator.ban_cache, self.history
+            )
+        )
+
+    def wait_time(self) -> float:
+        """
+        :return: 距离下一次 poll 的秒数, 事件模式下等到下一次获取 maindata,
+                 有 torrent 因令牌不足留下时等到有令牌
+        """
+        if not self.event_mode:
+            return self.scheduler.wait_time()
+        wait = self.scheduler.token_wait()
+        if not self.pending:
+            wait = max(wait, self.next_maindata - time.monotonic())
+        return max(wait, 0)
 
-    def check_download_speed(self, peer):
-        log.debug(f"{peer['ip']}.dl_speed: {peer['dl_speed']}")
-        return peer["dl_speed"] < self.min_download_speed
+    def poll(self):
+        """
+        轮询一次到期的 torrent, 之后应等待 self.wait_time() 秒
+        """
+        changed = {}
+        if time.monotonic() >= self.next_maindata \
+                and self.scheduler.take(1):
+            changed = self.sync.sync_torrents()
+            self.next_maindata = \
+                time.monotonic() + self.scheduler.min_interval
+        torrents = self.due_torrents(changed)
+        start = time.perf_counter()
+        for torrent in torrents:
+            # 只检查新增或有变化的 peer
+            self.check(torrent, self.sync.sync_peers(torrent["hash"]))
+            metrics.inc("torrents_polled_total")
+            self.ban_queue.maybe_flush()
+        if torrents:
+            metrics.observe("sweep_seconds", time.perf_counter() - start)
+        self.ban_queue.maybe_flush()
 
-    def check_upload_speed(self, peer):
-        log.debug(f"{peer['ip']}.up_speed: {peer['up_speed']}")
-        return peer["up_speed"] > self.max_upload_speed
+    def run(self):
+        while 1:
+            try:
+                self.poll()
+            except requests.RequestException as e:
+                log.error("%s: %r", self.name, e)
+            except Exception:
+                # 响应中缺少字段等意外错误, 记录后继续轮询, 不让线程退出
+                log.exception("%s: poll failed", self.name)
+            time.sleep(self.wait_time())
+
+    async def async_poll(self):
+        changed = {}
+        if time.monotonic() >= self.next_maindata \
+                and self.scheduler.take(1):
+            changed = await self.sync.async_sync_torrents()
+            self.next_maindata = \
+                time.monotonic() + self.scheduler.min_interval
+        torrents = self.due_torrents(changed)
+        if torrents:
+            start = time.perf_counter()
+            peers = await self.sync.async_sync_peers_many(
+                [torrent["hash"] for torrent in torrents]
+            )
+            metrics.inc("torrents_polled_total", len(torrents))
+            for torrent in torrents:
+                self.check(torrent, peers[torrent["hash"]])
+            metrics.observe("sweep_seconds", time.perf_counter() - start)
+        if self.ban_queue.due():
+            await asyncio.to_thread(self.ban_queue.flush)
 
-    def check_relevance(self, peer):
-        log.debug(f"{peer['ip']}.relevance: {peer['relevance']}")
-        return peer["relevance"] >= self.min_relevance
+    async def async_run(self, max_connections):
+        """
+        异步模式: 同时获取多个 torrent 的 peer, 并发数由 max_connections 限制,
+        一轮扫描的耗时取决于连接数而不是 torrent 的数量。
+        """
+        self.sync = AsyncSyncClient(
+            self.root_url, session=self.session,
+            max_connections=max_connections, recorder=self.recorder,
+        )
+        async with self.sync:
+            while 1:
+                try:
+                    await self.async_poll()
+                except Exception:
+                    log.exception("%s: poll failed", self.name)
+                await asyncio.sleep(self.wait_time())
 
-    def check_client(self, peer):
-        log.debug(f"{peer['ip']}.client: {peer['client']}")
-        return self.ban_clients.match(peer["client"])
+
+def housekeeping(ban_cache: BanCache, metrics_file=None):
+    ban_cache.maybe_save()
+    if metrics_file:
+        metrics.maybe_write(metrics_file)
+
+
+async def async_main(
+    instances: list[Instance], ban_cache: BanCache, max_connections,
+    metrics_file=None
+):
+    async def _housekeeping():
+        while 1:
+            await asyncio.to_thread(housekeeping, ban_cache, metrics_file)
+            await asyncio.sleep(1)
+
+    await asyncio.gather(
+        _housekeeping(),
+        *(instance.async_run(max_connections) for instance in instances),
+    )
 
 
 if __name__ == "__main__":
     DEBUG = False
+    # 异步模式需要安装 aiohttp
+    ASYNC_MODE = False
+    # 事件模式: 只获取 maindata 中 num_leechs, dlspeed 或 upspeed
+    # 有变化的 torrent 的 peer, 而不是轮询所有 torrent
+    EVENT_MODE = False
+    MAX_CONNECTIONS = 16
+    # 所有 qBittorrent 实例的 WebUI, 可以在 qB_ban.yaml 的 Instances 中配置,
+    # username 和 password 为空时不登录
+    INSTANCES = [
+        {
+            "name": "qBittorrent",
+            "url": "http://127.0.0.1:9080",
+            "username": None,
+            "password": None,
+        },
+    ]
+    POOL_SIZE = MAX_CONNECTIONS
+    # 每隔多少秒或累计多少个 peer 提交一次 banPeers
+    BAN_INTERVAL = 1
+    BAN_BATCH_SIZE = 100
+    # 已屏蔽的 peer 在 BAN_TTL 秒内不再检查
+    BAN_TTL = 24 * 3600
+    BAN_CACHE_SIZE = 65536
+    BAN_CACHE_BY_CLIENT = False
+    # 最多跟踪多少个 peer 的历史, 以及每个 peer 保留几次轮询的样本
+    PEER_HISTORY_SIZE = 65536
+    PEER_HISTORY_WINDOW = 8
+    # 活跃的 torrent 每 POLL_MIN_INTERVAL 秒轮询一次,
+    # 空闲的 torrent 轮询间隔按 POLL_BACKOFF 倍增加, 最长 POLL_MAX_INTERVAL 秒
+    POLL_MIN_INTERVAL = 1
+    POLL_MAX_INTERVAL = 300
+    POLL_BACKOFF = 2
+    # 所有实例合计每秒最多向 WebUI 发出的请求数, 平均分给每个实例, None 为不限制
+    POLL_RATE = 20
+    # 指标: METRICS_PORT 为 HTTP 导出器的端口,
+    # METRICS_FILE 为 node_exporter textfile collector 的 .prom 文件, None 为关闭
+    METRICS_PORT = None
+    METRICS_FILE = None
+    # 把 WebUI 的响应保存到该文件, 用 qB_ban_replay.py 回放, None 为关闭
+    RECORD_FILE = None
+    # tracker 列表, 每 TRACKERS_INTERVAL 秒检查一次是否有更新, None 为不更新
+    TRACKERS_URL = 'https://raw.githubusercontent.com/ngosang' \
+                   '/trackerslist/master/trackers_all_ip.txt'
+    TRACKERS_INTERVAL = 6 * 3600
+    TRACKERS_PROXIES = {
+        "http": "127.0.0.1:7890",
+        "https": "127.0.0.1:7890",
+    }
     RootPath = Path(__file__).parent
     LOGGING = {
         "version": 1,
@@ -134,6 +1756,9 @@ if __name__ == "__main__":
                 "format": "%(asctime)s %(levelname)s %(name)s "
                           "- %(message)s"
             },
+            "audit": {
+                "()": AuditFormatter,
+            },
         },
         "handlers": {
             "root": {
@@ -150,106 +1775,112 @@ if __name__ == "__main__":
                 "class": "logging.StreamHandler",
                 "formatter": "verbose",
             },
-            
+            "audit": {
+                "level": "INFO",
+                "class": "logging.handlers.TimedRotatingFileHandler",
+                "filename": RootPath / "qB_ban.audit.jsonl",
+                "encoding": "utf-8",
+                "when": "W0",
+                "backupCount": 6,
+                "formatter": "audit"
+            },
         },
         "loggers": {
             "root": {
                 "handlers": ["root"],
                 "level": "INFO" if not DEBUG else "DEBUG",
             },
+            "qB_ban.audit": {
+                "handlers": ["audit"],
+                "level": "INFO",
+                "propagate": False,
+            },
         },
     }
     dictConfig(LOGGING)
-    log = getLogger()
-    github_trackers_url = 'https://raw.githubusercontent.com/ngosang' \
-                          '/trackerslist/master/trackers_all_ip.txt'
-
-    root_url = 'http://127.0.0.1:9080'
-    get_preferences_url = root_url + '/api/v2/app/preferences'
-    set_preferences_url = root_url + '/api/v2/app/setPreferences'
-    torrents_url = root_url + '/api/v2/torrents/info'
-    peers_url = root_url + '/api/v2/sync/torrentPeers'
-    ban_peers_url = root_url + '/api/v2/transfer/banPeers'
-
-    log.info("=" * 80)
-    log.info("get preferences:")
-    preferences = json.loads(
-        requests.get(get_preferences_url).text.encode("utf-8")
+    # 写日志文件在后台线程中进行
+    queue_logging(log)
+    queue_logging(audit_log)
+    conf_path = RootPath / "qB_ban.yaml"
+    CONF = load_conf(conf_path) if conf_path.exists() else {}
+    if CONF.get("Rules"):
+        try:
+            BanPeerPolicy.rules = compile_rules(CONF["Rules"])
+        except (OSError, ValueError, re.error) as e:
+            log.error(f"{conf_path} Rules error: {e}")
+            raise SystemExit(1)
+    if CONF.get("Instances"):
+        INSTANCES = CONF["Instances"]
+
+    ban_cache = BanCache(
+        RootPath / "qB_ban.banned.json", ttl=BAN_TTL,
+        maxsize=BAN_CACHE_SIZE, by_client=BAN_CACHE_BY_CLIENT,
     )
-    for _key, _value in preferences.items():
-        log.info(f"{_key}: {_value}")
-    log.info("=" * 80)
-
-    try:
-        github_headers = {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,'
-                      'image/webp,image/apng,*/*;q=0.8,'
-                      'application/signed-exchange;v=b3 ',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                          'AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/108.0.5359.125 Safari/537.36 ',
-            'Accept-Encoding': 'gzip, deflate, br',
-        }
-        proxies = {
-            "http": "127.0.0.1:7890",
-            "https": "127.0.0.1:7890",
-        }
-        _res = requests.get(
-            github_trackers_url, proxies=proxies, headers=github_headers,
-            timeout=10,
-            )
-        _trackers = _res.text
-        log.info('加载tracker服务器列表成功。')
-    except requests.RequestException:
-        _trackers = None
-        log.error('加载tracker服务器列表失败。')
-    if _trackers and _trackers != preferences["add_trackers"]:
-        _params = {'add_trackers_enabled': True, 'add_trackers': _trackers}
-        _content = {'json': json.dumps(_params)}
-        requests.post(set_preferences_url, data=_content)
+    ban_cache.load()
+    atexit.register(ban_cache.save)
+    coordinator = BanCoordinator(ban_cache)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+        log.info(f"metrics: http://127.0.0.1:{METRICS_PORT}/metrics")
+    recorder = Recorder(RECORD_FILE) if RECORD_FILE else None
+    if recorder is not None:
+        atexit.register(recorder.close)
+
+    instances = []
+    for _conf in INSTANCES:
+        root_url = _conf["url"].rstrip("/")
+        session = WebUISession(
+            root_url, username=_conf.get("username"),
+            password=_conf.get("password"), pool_size=POOL_SIZE,
+        )
+        if not session.login():
+            raise SystemExit(1)
+        log.info("=" * 80)
+        log.info(f"{_conf.get('name', root_url)} get preferences:")
+        preferences = json.loads(
+            session.get(
+                root_url + '/api/v2/app/preferences'
+            ).text.encode("utf-8")
+        )
+        for _key, _value in preferences.items():
+            log.info(f"{_key}: {_value}")
+        log.info("=" * 80)
+        instances.append(Instance(
+            _conf.get("name", root_url), root_url, coordinator,
+            session=session,
+            scheduler=PollScheduler(
+                min_interval=POLL_MIN_INTERVAL,
+                max_interval=POLL_MAX_INTERVAL,
+                backoff=POLL_BACKOFF,
+                rate=POLL_RATE and POLL_RATE / len(INSTANCES),
+            ),
+            history=PeerHistory(
+                capacity=PEER_HISTORY_SIZE, window=PEER_HISTORY_WINDOW
+            ),
+            recorder=recorder,
+            ban_interval=BAN_INTERVAL, ban_batch_size=BAN_BATCH_SIZE,
+            event_mode=EVENT_MODE,
+        ))
+    if TRACKERS_URL:
+        TrackerRefresher(
+            TRACKERS_URL, RootPath / "trackers_all_ip.txt",
+            interval=TRACKERS_INTERVAL, proxies=TRACKERS_PROXIES,
+        ).start(instances)
     log.info('过滤器初始化成功。')
 
+    if ASYNC_MODE:
+        if aiohttp is None:
+            log.error('异步模式需要安装 aiohttp。')
+            raise SystemExit(1)
+        asyncio.run(
+            async_main(instances, ban_cache, MAX_CONNECTIONS, METRICS_FILE)
+        )
+
+    # 每个实例在自己的线程中轮询
+    for _instance in instances:
+        threading.Thread(
+            target=_instance.run, name=_instance.name, daemon=True
+        ).start()
     while 1:
-        _torrents = get_torrents(torrents_url)
-        for _torrent in _torrents:
-            if _torrent["state"].lower() in (
-                    "uploading", "downloading", "forcedup", "forceddl"
-            ):
-                ban_policy = BanPeerPolicy(torrent=_torrent)
-                log.debug(f"torrent name: {_torrent['name']}")
-                log.debug(f"torrent params:")
-                for _param, _value in _torrent.items():
-                    log.debug(f"{_param}: {pformat(_value)}")
-                for _peer in get_peers(peers_url, _torrent["hash"]).values():
-                    log.debug(f'peer ip: {_peer["ip"]}')
-                    log.debug(f"peer params:")
-                    for _param, _value in _peer.items():
-                        log.debug(f'{_param}: {pformat(_value)}')
-                    log.debug(f'{pformat(_peer)}')
-                    and_res = {
-                        func.__name__: func(_peer)
-                        for func in ban_policy.policy["and"]
-                    }
-                    or_res = {
-                        func.__name__: func(_peer)
-                        for func in ban_policy.policy["or"]
-                    }
-                    if and_res.values() and all(and_res.values()) \
-                            or any(or_res.values()):
-                        log.info("=" * 80)
-                        log.info(f"and_res: {and_res}")
-                        log.info(f"or_res: {or_res}")
-                        log.info(
-                            f"leeches were detected in this torrent: "
-                            f"{_torrent['name']}({_torrent['progress']})"
-                        )
-                        log.info("will be banned:")
-                        for _key, _value in _peer.items():
-                            log.info(f'{_key}: {_value}')
-                        ban_peers(
-                            ban_peers_url,
-                            [f"{_peer['ip']}" f":{_peer['port']}"]
-                        )
-                        time.sleep(1)
-                time.sleep(1)
+        housekeeping(ban_cache, METRICS_FILE)
         time.sleep(1)
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""The Module Has Been Build for replay and benchmark qB_ban policies"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import basicConfig, WARNING
+from urllib.parse import urlsplit, parse_qs
+
+import qB_ban
+from qB_ban import (
+    SyncClient, AsyncSyncClient, BanPeerPolicy, WebUISession,
+    active_torrents, detect_leeches,
+)
+
+
+MAINDATA = "/api/v2/sync/maindata"
+TORRENT_PEERS = "/api/v2/sync/torrentPeers"
+TORRENTS_INFO = "/api/v2/torrents/info"
+TRACKERS = "/trackers_all_ip.txt"
+
+
+class Recording(object):
+    """
+    qB_ban.Recorder 保存的响应, 每个接口 (torrentPeers 按 hash 区分)
+    按录制时的顺序依次返回, 全部返回后只返回 "没有变化"。
+    """
+
+    def __init__(self, path, speed: float = 1):
+        """
+        :param speed: 回放速度的倍数, 0 为不等待
+        """
+        self.speed = speed
+        self.responses = defaultdict(deque)
+        self.last_rid = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.responses[
+                    self.key(entry["endpoint"], entry["params"])
+                ].append(entry)
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        # 用于 torrents/info
+        self.model = SyncClient("")
+
+    @staticmethod
+    def key(endpoint, params: dict):
+        if endpoint == TORRENT_PEERS:
+            return f"{endpoint}/{params['hash']}"
+        return endpoint
+
+    def respond(self, endpoint, params: dict):
+        if endpoint == TORRENTS_INFO:
+            with self.lock:
+                return list(self.model.torrents.values())
+        key = self.key(endpoint, params)
+        with self.lock:
+            responses = self.responses.get(key)
+            entry = responses.popleft() if responses else None
+        if entry is None:
+            return {"rid": self.last_rid.get(key, 0), "full_update": False}
+        if self.speed:
+            wait = self.start + entry["time"] / self.speed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        data = entry["data"]
+        self.last_rid[key] = data.get("rid", 0)
+        if endpoint == MAINDATA:
+            with self.lock:
+                self.model.apply_maindata(data)
+        return data
+
+
+class SyntheticSwarm(object):
+    """
+    生成 num_peers 个 peer 的虚拟 swarm, 每个 torrent 有 peers_per_torrent 个
+    peer, 每个 torrent 的 peer 在请求时才生成, 内存占用与 swarm 大小无关。
+    """
+
+    clients = (
+        "qBittorrent 4.5.2", "Transmission 3.00", "μTorrent 3.5.5",
+        "Xunlei 0.0.1.2", "-XL0012-", "xfplay", "libtorrent 1.2",
+        "BitComet 1.98", "7.10.5", "Deluge 2.1.1",
+    )
+    countries = ("cn", "us", "de", "jp", "ru", "fr", "br", "kr")
+
+    def __init__(self, num_peers, peers_per_torrent=1000, seed=0):
+        self.num_peers = num_peers
+        self.peers_per_torrent = peers_per_torrent
+        self.seed = seed
+        self.torrents = {}
+        self.index = {}
+        for i in range(-(-num_peers // peers_per_torrent)):
+            hash_id = f"{seed:08x}{i:032x}"
+            self.index[hash_id] = i
+            self.torrents[hash_id] = {
+                "name": f"synthetic-{i}",
+                "state": "downloading" if i % 2 else "uploading",
+                "size": 4 * 1024 ** 3,
+                "progress": 0.5,
+                "num_leechs": peers_per_torrent,
+                "dlspeed": 0,
+                "upspeed": 0,
+            }
+
+    def peers(self, hash_id) -> dict:
+        index = self.index[hash_id]
+        rng = random.Random(f"{self.seed}/{hash_id}")
+        count = min(
+            self.peers_per_torrent,
+            self.num_peers - index * self.peers_per_torrent
+        )
+        size = self.torrents[hash_id]["size"]
+        peers = {}
+        for i in range(count):
+            ip = f"10.{index % 256}.{i // 256 % 256}.{i % 256}"
+            port = 6881 + i // 65536
+            peers[f"{ip}:{port}"] = {
+                "ip": ip,
+                "port": port,
+                "client": rng.choice(self.clients),
+                "country_code": rng.choice(self.countries),
+                "connection": rng.choice(("BT", "μTP")),
+                "flags": rng.choice(("D", "U", "D X E", "u P", "I")),
+                "progress": rng.random(),
+                "relevance": rng.random(),
+                "uploaded": rng.random() * 0.05 * size,
+                "downloaded": rng.random() * 0.05 * size,
+                "up_speed": rng.random() * 16 * 1024,
+                "dl_speed": rng.random() * 4 * 1024,
+            }
+        return peers
+
+    def respond(self, endpoint, params: dict):
+        if endpoint == MAINDATA:
+            return {"rid": 1, "full_update": True, "torrents": self.torrents}
+        if endpoint == TORRENT_PEERS:
+            return {
+                "rid": 1, "full_update": True,
+                "peers": self.peers(params["hash"]),
+            }
+        if endpoint == TORRENTS_INFO:
+            return [
+                dict(torrent, hash=hash_id)
+                for hash_id, torrent in self.torrents.items()
+            ]
+        return None
+
+
+def serve(source, port: int = 0, addr: str = "127.0.0.1"):
+    """
+    在后台线程中运行一个代替 qBittorrent WebUI 的 HTTP 服务,
+    sync 接口的数据来自 source, 登录, 设置和 banPeers 总是成功。
+    :return: server, server.banned 为收到的 banPeers,
+             修改 server.trackers 可以测试 TrackerRefresher
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, data, content_type="application/json"):
+            if isinstance(data, str):
+                body = data.encode("utf-8")
+            else:
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            if url.path == "/api/v2/app/preferences":
+                return self.reply({"add_trackers": server.add_trackers})
+            if url.path == TRACKERS:
+                return self.reply_trackers()
+            data = source.respond(url.path, params)
+            if data is None:
+                self.send_error(404)
+            else:
+                self.reply(data)
+
+        def reply_trackers(self):
+            """
+            代替 tracker 列表的下载地址, 支持 If-None-Match
+            """
+            etag = '"%s"' % hashlib.sha1(
+                server.trackers.encode("utf-8")
+            ).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = server.trackers.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            form = parse_qs(self.rfile.read(length).decode("utf-8"))
+            if url.path == "/api/v2/auth/login":
+                self.send_response(200)
+                self.send_header("Set-Cookie", "SID=replay; path=/")
+                self.send_header("Content-Length", "3")
+                self.end_headers()
+                self.wfile.write(b"Ok.")
+                return
+            if url.path == "/api/v2/transfer/banPeers":
+                peers = form.get("peers", [""])[-1]
+                server.banned.extend(p for p in peers.split("|") if p)
+            if url.path == "/api/v2/app/setPreferences":
+                preferences = json.loads(form.get("json", ["{}"])[-1])
+                server.add_trackers = preferences.get(
+                    "add_trackers", server.add_trackers
+                )
+            self.reply("", "text/plain")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+    server.banned = []
+    # http://addr:port/trackers_all_ip.txt 的内容
+    server.trackers = ""
+    server.add_trackers = ""
+    threading.Thread(
+        target=server.serve_forever, name="stand-in webui", daemon=True
+    ).start()
+    return server
+
+
+def sweep(root_url) -> tuple[int, int, float]:
+    """
+    用 SyncClient 完整扫描一次
+    :return: torrent 数量, peer 数量, 耗时
+    """
+    start = time.perf_counter()
+    sync = SyncClient(root_url, session=WebUISession(root_url))
+    sync.sync_torrents()
+    peers = 0
+    for torrent in active_torrents(sync.torrents):
+        peers += len(sync.sync_peers(torrent["hash"]))
+        detect_leeches(torrent, sync.peers[torrent["hash"]])
+    return len(sync.torrents), peers, time.perf_counter() - start
+
+
+async def async_sweep(root_url, max_connections) -> tuple[int, int, float]:
+    start = time.perf_counter()
+    async with AsyncSyncClient(
+        root_url, max_connections=max_connections
+    ) as sync:
+        await sync.async_sync_torrents()
+        torrents = active_torrents(sync.torrents)
+        changed = await sync.async_sync_peers_many(
+            [torrent["hash"] for torrent in torrents]
+        )
+        for torrent in torrents:
+            detect_leeches(torrent, sync.peers[torrent["hash"]])
+    peers = sum(len(v) for v in changed.values())
+    return len(sync.torrents), peers, time.perf_counter() - start
+
+
+def bench(sizes, peers_per_torrent=1000, max_connections=16, seed=0):
+    print(
+        f"{'peers':>9} {'torrents':>8} {'evaluate peers/s':>17} "
+        f"{'sweep s':>8} {'async sweep s':>13}"
+    )
+    for size in sizes:
+        swarm = SyntheticSwarm(size, peers_per_torrent, seed)
+        # 只计算规则本身的耗时
+        evaluated = 0
+        elapsed = 0
+        for hash_id, torrent in swarm.torrents.items():
+            torrent = dict(torrent, hash=hash_id)
+            peers = swarm.peers(hash_id)
+            policy = BanPeerPolicy(torrent)
+            start = time.perf_counter()
+            policy.evaluate(peers)
+            elapsed += time.perf_counter() - start
+            evaluated += len(peers)
+        # 通过 HTTP 的完整扫描
+        server = serve(swarm)
+        root_url = "http://%s:%d" % server.server_address
+        _, _, sweep_time = sweep(root_url)
+        async_time = None
+        if qB_ban.aiohttp is not None:
+            _, _, async_time = asyncio.run(
+                async_sweep(root_url, max_connections)
+            )
+        server.shutdown()
+        server.server_close()
+        async_time = "-" if async_time is None else f"{async_time:.2f}"
+        print(
+            f"{size:>9} {len(swarm.torrents):>8} "
+            f"{evaluated / elapsed:>17.0f} {sweep_time:>8.2f} "
+            f"{async_time:>13}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="不运行 qBittorrent, 回放 qB_ban 录制的响应, "
+                    "或用虚拟的 swarm 测试屏蔽规则的性能。",
+        epilog="""
+e.g:
+录制: 在 qB_ban.py 中设置 RECORD_FILE 后正常运行
+回放, 把 qB_ban.py 的 INSTANCES (或 qB_ban.yaml 的 Instances)
+中的 url 改为 http://127.0.0.1:9090:
+    python qB_ban_replay.py replay qB_ban.record.jsonl --port 9090 --speed 10
+性能测试:
+    python qB_ban_replay.py bench --sizes 10000 100000 1000000
+""",
+    )
+    subcmd = parser.add_subparsers(title="subcmd", dest="subcmd")
+    replay_cmd = subcmd.add_parser("replay", help="代替 WebUI 回放录制的响应")
+    replay_cmd.add_argument("record", help="RECORD_FILE 录制的文件")
+    replay_cmd.add_argument("--port", type=int, default=9090)
+    replay_cmd.add_argument(
+        "--speed", type=float, default=1, help="回放速度的倍数, 0 为不等待"
+    )
+    bench_cmd = subcmd.add_parser("bench", help="性能测试")
+    bench_cmd.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+        help="swarm 中 peer 的数量",
+    )
+    bench_cmd.add_argument("--peers-per-torrent", type=int, default=1000)
+    bench_cmd.add_argument("--max-connections", type=int, default=16)
+    bench_cmd.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    basicConfig(level=WARNING)
+
+    if args.subcmd == "replay":
+        _server = serve(Recording(args.record, args.speed), args.port)
+        print("stand-in WebUI: http://%s:%d" % _server.server_address)
+        try:
+            while 1:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(f"banned: {len(_server.banned)}")
+    elif args.subcmd == "bench":
+        bench(
+            args.sizes, args.peers_per_torrent, args.max_connections,
+            args.seed,
+        )
+    else:
+        parser.print_help()
@@ -2,33 +2,344 @@
 # Author      : ShiFan
 # Created Date: 2019/10/15 15:45
 import os
+import queue
 import shutil
-import socket
-from copy import copy, deepcopy
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 
-from watchdog.events import RegexMatchingEventHandler
+from watchdog.events import (
+    RegexMatchingEventHandler, EVENT_TYPE_CREATED, EVENT_TYPE_DELETED,
+    EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED, DirCreatedEvent,
+    DirDeletedEvent, DirMovedEvent, FileCreatedEvent, FileDeletedEvent,
+    FileModifiedEvent, FileMovedEvent, )
 
 from fabric import Connection
-from paramiko import SSHException
-from paramiko.ssh_exception import (
-    NoValidConnectionsError, AuthenticationException, )
 
-from util import ip_check, get_dest_path, put_one, enforce
+from manifest import Manifest, scan_tree, relative_path, hash_file
+from util import (
+    ip_check, get_dest_path, put_one, enforce, get_session, PathFilter,
+    CONNECTION_ERRORS, )
 from conf import CONF, logger
 
 
+def make_event(event_type, is_directory, src_path, dest_path=None):
+    if event_type == EVENT_TYPE_MOVED:
+        cls = DirMovedEvent if is_directory else FileMovedEvent
+        return cls(src_path, dest_path)
+    if event_type == EVENT_TYPE_CREATED:
+        cls = DirCreatedEvent if is_directory else FileCreatedEvent
+    elif event_type == EVENT_TYPE_MODIFIED:
+        cls = FileModifiedEvent
+    else:
+        cls = DirDeletedEvent if is_directory else FileDeletedEvent
+    return cls(src_path)
+
+
+class EventQueue(object):
+    """
+    按路径合并事件, 一个路径在 quiet_window 秒内没有新事件后才取出,
+    created + modified + modified 合并为一次 created,
+    created + deleted 互相抵消, moved 之前未同步的事件跟随到新路径。
+    """
+
+    def __init__(self, quiet_window=0.5):
+        self.quiet_window = quiet_window
+        # path -> [最后一次事件的时间, [event, ...]], 按最后一次事件的时间排序
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, event):
+        if event.is_directory and event.event_type == EVENT_TYPE_MODIFIED:
+            return
+        with self.cond:
+            if event.event_type == EVENT_TYPE_MOVED:
+                self._moved(event)
+            else:
+                events = self._fold(
+                    self.pending.pop(event.src_path, [0, []])[1], event)
+                if events:
+                    self.pending[event.src_path] = [time.monotonic(), events]
+            self.cond.notify()
+
+    @staticmethod
+    def _fold(events, event):
+        """
+        :param events: 同一路径上还没有同步的事件
+        :return: 合并后的事件列表
+        """
+        if not events:
+            return [event]
+        first, last = events[0], events[-1]
+        if event.event_type == EVENT_TYPE_MODIFIED:
+            if last.event_type in (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED):
+                return events
+            if last.event_type == EVENT_TYPE_MOVED:
+                return events + [event]
+            return [make_event(EVENT_TYPE_CREATED, False, event.src_path)]
+        if event.event_type == EVENT_TYPE_DELETED:
+            if first.event_type == EVENT_TYPE_CREATED:
+                return []
+            if first.event_type == EVENT_TYPE_MOVED:
+                # 远程还是移动之前的路径
+                return [make_event(EVENT_TYPE_DELETED, first.is_directory,
+                                   first.src_path)]
+            return [event]
+        # created
+        if first.event_type == EVENT_TYPE_MOVED:
+            return [make_event(EVENT_TYPE_DELETED, first.is_directory,
+                               first.src_path), event]
+        return [event]
+
+    @staticmethod
+    def _retarget(events, src_path, dest_path):
+        """
+        src_path 移动到 dest_path 后, 把事件中 src_path 以及它下面的路径
+        改到 dest_path 下, 去掉起点和终点相同的移动
+        """
+        prefix = src_path + os.sep
+
+        def rename(path):
+            if path == src_path or path.startswith(prefix):
+                return dest_path + path[len(src_path):]
+            return path
+
+        result = []
+        for e in events:
+            if e.event_type == EVENT_TYPE_MOVED:
+                src, dest = rename(e.src_path), rename(e.dest_path)
+                if src != dest:
+                    result.append(make_event(
+                        EVENT_TYPE_MOVED, e.is_directory, src, dest))
+            else:
+                result.append(make_event(
+                    e.event_type, e.is_directory, rename(e.src_path)))
+        return result
+
+    def _moved(self, event):
+        now = time.monotonic()
+        self.pending.pop(event.dest_path, None)
+        events = self.pending.pop(event.src_path, [0, []])[1]
+        if not events:
+            events = [event]
+        elif events[-1].event_type == EVENT_TYPE_CREATED:
+            # 远程还没有 src_path, 直接在新路径上创建
+            events = events[:-1] + [make_event(
+                EVENT_TYPE_CREATED, event.is_directory, event.dest_path)]
+        elif events[0].event_type == EVENT_TYPE_MOVED:
+            # 合并为一次移动, 之后的事件改到新路径, 移回原处时不再移动
+            events = self._retarget(events, event.src_path, event.dest_path)
+        elif events[0].event_type == EVENT_TYPE_MODIFIED:
+            events = [event, make_event(EVENT_TYPE_MODIFIED, False,
+                                        event.dest_path)]
+        else:
+            events = [event]
+        if events:
+            self.pending[event.dest_path] = [now, events]
+        if event.is_directory:
+            # 目录中还没有同步的事件跟随目录移动, 排在目录的移动之后
+            prefix = event.src_path + os.sep
+            for path in [p for p in self.pending if p.startswith(prefix)]:
+                new_path = event.dest_path + path[len(event.src_path):]
+                _events = self._retarget(
+                    self.pending.pop(path)[1],
+                    event.src_path, event.dest_path)
+                if _events:
+                    self.pending[new_path] = [now, _events]
+
+    def get(self):
+        """
+        阻塞直到有路径静默了 quiet_window 秒, 关闭后返回剩余的全部事件
+        :return: [event, ...], 关闭且没有事件时返回 None
+        """
+        with self.cond:
+            while True:
+                if self.closed:
+                    if not self.pending:
+                        return None
+                    return self._pop(float('inf'))
+                if self.pending:
+                    first = next(iter(self.pending.values()))[0]
+                    timeout = first + self.quiet_window - time.monotonic()
+                    if timeout <= 0:
+                        return self._pop(time.monotonic() - self.quiet_window)
+                else:
+                    timeout = None
+                self.cond.wait(timeout)
+
+    def _pop(self, deadline):
+        events = []
+        while self.pending:
+            path, (last, _events) = next(iter(self.pending.items()))
+            if last > deadline:
+                break
+            del self.pending[path]
+            events.extend(_events)
+        return events
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class DestinationWorker(object):
+    """
+    每个目标一个线程和一个队列, 同一目标的事件按顺序同步,
+    不同目标之间互不等待。
+    """
+
+    def __init__(self, handler, connection=None, local=None,
+                 keepalive=30):
+        self.handler = handler
+        self.connection = connection
+        self.local = local
+        self.keepalive = keepalive
+        self.remote = [connection] if connection is not None else []
+        self.locals = [local] if local is not None else []
+        self.name = connection.host if connection is not None \
+            else local['path']
+        # 远程目标上已有的文件, 用于启动和重新连接后只同步有差异的文件
+        self.manifest = Manifest.for_destination(
+            connection.host, connection.path, connection.port) \
+            if connection is not None else None
+        self.lost = False
+        # 有同步失败, 下一次连接成功后 (包括第一次) 需要 reconcile
+        self.stale = False
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, name=f'sync to {self.name}', daemon=True)
+        self.thread.start()
+
+    def put(self, events):
+        self.queue.put(events)
+
+    def run(self):
+        while True:
+            events = self.queue.get()
+            if events is None:
+                return
+            if not events:
+                self.retry()
+            for event in events:
+                self.apply(event)
+
+    def retry(self):
+        """
+        check_health 在有同步失败且没有连接时放入空的事件列表,
+        在这个线程中重新连接, 连接成功后 reconcile
+        """
+        try:
+            self.connect()
+        except CONNECTION_ERRORS as e:
+            logger.debug(f'{self.name}: reconnection failed: {e!r}')
+
+    @enforce
+    def apply(self, event):
+        """
+        不预先检查连接, 同步失败时才重新连接并重试一次
+        """
+        try:
+            self.connect()
+            ok = self.handler.apply(event, self.remote, self.locals)
+        except CONNECTION_ERRORS as e:
+            if self.connection is None:
+                raise
+            logger.warning(f'{self.name}: {e!r}, reconnection')
+            try:
+                self.connection.close()
+                self.connect()
+                ok = self.handler.apply(event, self.remote, self.locals)
+            except CONNECTION_ERRORS as e:
+                logger.error(f'{self.name}: {event} failed: {e!r}')
+                self.stale = True
+                assert not CONF.get("DebugMode"), e
+                return
+        # 同步失败时不记录, 由下一次连接成功后的 reconcile 重新推送
+        if not ok:
+            self.stale = True
+        elif self.manifest is not None:
+            self.record(event)
+
+    def record(self, event):
+        """
+        同步成功后更新清单
+        """
+        src = self.handler.src
+        rel = relative_path(src, event.src_path)
+        if event.event_type == EVENT_TYPE_DELETED:
+            self.manifest.forget(rel)
+        elif event.event_type == EVENT_TYPE_MOVED:
+            self.manifest.move(rel, relative_path(src, event.dest_path))
+        elif event.is_directory:
+            # 目录的 modified 事件没有推送任何文件
+            if event.event_type == EVENT_TYPE_CREATED:
+                self.manifest.update(self.manifest.scan(
+                    src, self.handler.scan(event.src_path)))
+        else:
+            try:
+                st = os.stat(event.src_path)
+                sha256 = hash_file(event.src_path)
+            except OSError:
+                return
+            self.manifest.update({rel: [st.st_size, st.st_mtime_ns,
+                                        sha256]})
+
+    def connect(self):
+        c = self.connection
+        if c is None or c.is_connected:
+            return
+        # 之前连接过, 或者有同步失败 (例如启动时目标不可用),
+        # 断开期间的修改和失败的同步需要重新同步
+        reconnect = c.transport is not None or self.stale
+        c.open()
+        # 由 transport 定时发送 keepalive, 不再每次同步前执行 hostname
+        c.transport.set_keepalive(self.keepalive)
+        self.lost = False
+        if reconnect:
+            self.stale = False
+            self.handler.reconcile([self])
+
+    def check_health(self):
+        """
+        由 SyncEventHandler 的后台线程定时调用, 只检查本地的 transport 状态,
+        断开的连接会被关闭, 下一次同步时重新连接。
+        """
+        c = self.connection
+        if c is not None and c.transport is not None \
+                and not self.lost and not c.is_connected:
+            logger.warning(f'{self.name}: connection lost')
+            self.lost = True
+            c.close()
+        if c is not None and self.stale and not c.is_connected:
+            self.put([])
+        if self.manifest is not None and self.manifest.dirty:
+            self.manifest.save()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.manifest is not None and self.manifest.dirty:
+            self.manifest.save()
+
+
 class SyncEventHandler(RegexMatchingEventHandler):
     """Sync src to dst"""
 
     def __init__(self, source, destinations, regexes=None,
                  ignore_regexes=[], ignore_directories=False,
-                 case_sensitive=True):
+                 case_sensitive=True, quiet_window=0.5, keepalive=30):
         if not regexes:
             regexes = [r'.*']
 
         super().__init__(
                 regexes, ignore_regexes, ignore_directories, case_sensitive)
+        self.filter = PathFilter(regexes, ignore_regexes, case_sensitive)
         if not isinstance(destinations, list):
             raise TypeError('dst must be list')
         self.remote = []
@@ -59,6 +370,22 @@ class SyncEventHandler(RegexMatchingEventHandler):
             else:
                 self.local.append(dst)
         self.src = source
+        self.workers = [DestinationWorker(self, connection=c,
+                                          keepalive=keepalive)
+                        for c in self.remote]
+        self.workers.extend(DestinationWorker(self, local=l)
+                            for l in self.local)
+        self.queue = EventQueue(quiet_window)
+        self.worker = threading.Thread(
+            target=self.drain, name=f'sync {source}', daemon=True)
+        self.worker.start()
+        self.keepalive = keepalive
+        self.stopped = threading.Event()
+        self.monitor = threading.Thread(
+            target=self.watch, name=f'monitor {source}', daemon=True)
+        self.monitor.start()
+        threading.Thread(target=self.reconcile, name=f'reconcile {source}',
+                         daemon=True).start()
 
     def _create_connection(self, **dst):
         assert ip_check(dst['host']), 'host error'
@@ -66,46 +393,113 @@ class SyncEventHandler(RegexMatchingEventHandler):
                         user=dst.pop('user', None), connect_kwargs=dst) as c:
             return c
 
-    def _check_connection(self, connection):
-        try:
-            connection.run("hostname", hide=True, warn=True)
-            return True
-        except (AuthenticationException, NoValidConnectionsError,
-                    socket.timeout, SSHException, socket.error) as e:
-            logger.error(e)
-            assert not CONF.get("DebugMode"), e
-            return False
-
     def dispatch(self, event):
-        tmp_c = copy(self.remote)
-        for c in tmp_c:
-            if not self._check_connection(c):
-                self.remote.remove(c)
-                logger.warning("reconnection")
-                _c = self._create_connection(host=c.host, user=c.user,
-                                             port=c.port, **c.connect_kwargs)
-                _c.path = c.path
-                self.remote.append(_c)
-        return super(SyncEventHandler, self).dispatch(event)
+        """
+        与 RegexMatchingEventHandler.dispatch 相同, 但使用预先编译的
+        PathFilter, 被忽略的目录下的事件也会被忽略
+        """
+        if self.ignore_directories and event.is_directory:
+            return
+        paths = [os.fsdecode(event.src_path)]
+        if hasattr(event, 'dest_path'):
+            paths.append(os.fsdecode(event.dest_path))
+        if any(self.filter.ignored(p) for p in paths):
+            return
+        if any(self.filter.match(p) for p in paths):
+            super(RegexMatchingEventHandler, self).dispatch(event)
+
+    def scan(self, path) -> dict:
+        """
+        与 dispatch 使用相同的规则, 忽略的目录不再进入
+        """
+        return {p: st for p, st in
+                scan_tree(path, self.filter.ignored).items()
+                if self.filter.match(p)}
+
+    def reconcile(self, workers=None):
+        """
+        比较本地目录树和目标的清单, 只把有差异的文件交给目标的线程,
+        补上没有运行或者连接断开期间的修改。
+        """
+        workers = [w for w in workers or self.workers
+                   if w.manifest is not None]
+        if not workers:
+            return
+        start_time = time.time()
+        stats = self.scan(self.src)
+        for worker in workers:
+            changed, _, deleted = worker.manifest.reconcile(self.src, stats)
+            # 只删除本地确实不存在的文件, 不包括被忽略的文件
+            deleted = [rel for rel in deleted
+                       if not os.path.lexists(Path(self.src) / rel)]
+            events = [FileModifiedEvent(path) for path in changed]
+            events.extend(FileDeletedEvent(str(Path(self.src) / rel))
+                          for rel in deleted)
+            logger.info(f'{worker.name}: reconcile {len(stats)} files in '
+                        f'{time.time() - start_time:.1f}s, '
+                        f'{len(changed)} changed, {len(deleted)} deleted')
+            if events:
+                worker.put(events)
+
+    def watch(self):
+        """
+        定时检查所有远程连接的状态
+        """
+        while not self.stopped.wait(self.keepalive):
+            for worker in self.workers:
+                worker.check_health()
+
+    def drain(self):
+        """
+        取出合并后的事件, 交给每个目标的线程
+        """
+        while True:
+            events = self.queue.get()
+            if events is None:
+                return
+            for worker in self.workers:
+                worker.put(events)
+
+    def close(self):
+        """
+        同步剩余的事件后退出
+        """
+        self.stopped.set()
+        self.queue.close()
+        self.worker.join()
+        for worker in self.workers:
+            worker.close()
+
+    def apply(self, event, remote, local) -> bool:
+        """
+        :return: 是否同步成功, sync_* 中的异常被 enforce 捕获时为 None
+        """
+        return {
+            EVENT_TYPE_CREATED: self.sync_created,
+            EVENT_TYPE_DELETED: self.sync_deleted,
+            EVENT_TYPE_MODIFIED: self.sync_modified,
+            EVENT_TYPE_MOVED: self.sync_moved,
+        }[event.event_type](event, remote, local)
+
+    def on_any_event(self, event):
+        if event.event_type in (EVENT_TYPE_CREATED, EVENT_TYPE_DELETED,
+                                EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED):
+            logger.debug(f'queue {event}')
+            self.queue.put(event)
 
     @enforce
-    def on_created(self, event):
-        super().on_created(event)
+    def sync_created(self, event, remote, local):
         logger.info(f'Create: {event.src_path}')
 
         if event.is_directory:
+            ok = True
             if Path(event.src_path).stat().st_size == 0:
-                for c in self.remote:
+                for c in remote:
                     dst_path = get_dest_path(self.src, event.src_path,
                                              c.path)
                     logger.info(f'mkdir {dst_path}')
-                    res = c.run(f'mkdir -p {dst_path}', hide=True,
-                                warn=True)
-                    if res.stdout:
-                        logger.info(res.stdout)
-                    if res.stderr:
-                        logger.error(res.stderr)
-                for l in self.local:
+                    get_session(c).makedirs([dst_path])
+                for l in local:
                     dst_path = get_dest_path(self.src, event.src_path,
                                              l['path'])
                     os.makedirs(dst_path)
@@ -114,52 +508,54 @@ class SyncEventHandler(RegexMatchingEventHandler):
                     for fs in f:
                         src_ = Path(b) / fs
                         src_ = src_.__str__()
-                        for c in self.remote:
-                            put_one(self.src, src_, c.path, c)
-                        for l in self.local:
+                        for c in remote:
+                            if put_one(self.src, src_, c.path, c) is None:
+                                ok = False
+                        for l in local:
                             dst_path = get_dest_path(self.src, src_,
                                                      l['path'])
                             os.makedirs(Path(dst_path).parent)
                             logger.info(f'cp {src_} to {dst_path}')
                             shutil.copy(src_, dst_path)
+            return ok
         else:
-            for c in self.remote:
-                put_one(self.src, event.src_path, c.path, c)
-            for l in self.local:
+            ok = all([put_one(self.src, event.src_path, c.path, c)
+                      is not None for c in remote])
+            for l in local:
                 dst_path = get_dest_path(self.src, event.src_path,
                                          l['path'])
                 os.makedirs(Path(dst_path).parent)
                 logger.info(f'cp {event.src_path} to {dst_path}')
                 shutil.copy(event.src_path, dst_path)
+            return ok
 
     @enforce
-    def on_moved(self, event):
-        super().on_moved(event)
+    def sync_moved(self, event, remote, local):
         logger.info(f'MOVE: {event.src_path} to {event.dest_path}')
         # if event.is_directory and Path(event.src_path).stat().st_size > 0:
         #     logger.warning(f'{event.src_path} not empty, size: '
         #                      f'{Path(event.src_path).stat().st_size}')
-        for c in self.remote:
+        ok = True
+        for c in remote:
             dest_src_path = get_dest_path(self.src, event.src_path,
                                           c.path)
             dest_dst_path = get_dest_path(self.src, event.dest_path,
                                           c.path)
             logger.info(f'{c.host}: mv {dest_src_path} to'
                           f' {dest_dst_path}')
-            res = c.run(
-                    f'mkdir -p {os.path.dirname(dest_dst_path)}',
-                    hide=True, warn=True)
-            if res.stdout:
-                logger.info(res.stdout)
-            if res.stderr:
-                logger.error(res.stderr)
+            session = get_session(c)
+            session.makedirs([os.path.dirname(dest_dst_path)])
+            session.forget(dest_src_path)
+            session.forget(dest_dst_path)
             res = c.run(f'mv {dest_src_path} {dest_dst_path}',
                         hide=True, warn=True)
             if res.stdout:
                 logger.info(res.stdout)
             if res.stderr:
                 logger.error(res.stderr)
-        for l in self.local:
+            if res.failed:
+                ok = False
+        for l in local:
             dest_src_path = get_dest_path(self.src, event.src_path,
                                           l['path'])
             dest_dst_path = get_dest_path(self.src, event.dest_path,
@@ -167,47 +563,51 @@ class SyncEventHandler(RegexMatchingEventHandler):
             logger.info(f'mv {dest_src_path} to {dest_dst_path}')
             os.makedirs(Path(dest_dst_path).parent)
             shutil.move(dest_src_path, dest_dst_path)
+        return ok
 
     @enforce
-    def on_modified(self, event):
-        super().on_modified(event)
+    def sync_modified(self, event, remote, local):
         logger.info(f'Modified: {event.src_path}')
         if event.is_directory:
-            return
+            return True
         else:
-            for c in self.remote:
-                put_one(self.src, event.src_path, c.path, c)
-            for l in self.local:
+            ok = all([put_one(self.src, event.src_path, c.path, c)
+                      is not None for c in remote])
+            for l in local:
                 dst_path = get_dest_path(self.src, event.src_path,
                                          l['path'])
                 logger.info(f'cp {event.src_path} to {dst_path}')
                 shutil.copy(event.src_path, dst_path)
+            return ok
 
     @enforce
-    def on_deleted(self, event):
-        super().on_deleted(event)
+    def sync_deleted(self, event, remote, local):
         logger.info(f'Deleted: {event.src_path}')
-
-        for c in self.remote:
+        ok = True
+        for c in remote:
             dst_path = get_dest_path(self.src, event.src_path, c.path)
             if dst_path.startswith('/'):
                 # unix command
                 logger.info(
                     f'{c.host}: rm -rf {dst_path}')
                 res = c.run(f'rm -rf {dst_path}', hide=True, warn=True)
+                get_session(c).forget(dst_path)
                 if res.stdout:
                     logger.info(res.stdout)
                 if res.stderr:
                     logger.error(res.stderr)
+                if res.failed:
+                    ok = False
             else:
                 # TODO: windows command
                 c.run('')
-        for l in self.local:
+        for l in local:
             dst_path = get_dest_path(self.src, event.src_path, l['path'])
             logger.info(f'rm -rf {dst_path}')
             if event.is_directory:
                 os.removedirs(dst_path)
             else:
                 os.remove(dst_path)
+        return ok
 
 
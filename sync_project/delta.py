@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""The Module Has Been Build for rsync-style delta transfer"""
+import base64
+import hashlib
+import io
+import json
+import math
+import mmap
+import shlex
+import struct
+import zlib
+from pathlib import Path
+
+from fabric import Connection
+from paramiko import SFTPClient
+
+from conf import CONF, logger
+
+
+# 在远程主机上执行的脚本, 兼容较老的 python3, 不使用 f-string
+REMOTE_HELPER = r'''
+import hashlib, json, os, struct, sys, zlib
+
+
+def signature(path, block_size):
+    try:
+        f = open(path, "rb")
+    except (IOError, OSError):
+        return None
+    blocks = []
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            blocks.append([zlib.adler32(block) & 0xffffffff,
+                           hashlib.md5(block).hexdigest()])
+    return {"size": size, "blocks": blocks}
+
+
+def patch(path, delta_path, block_size, expected):
+    tmp_path = path + ".delta.tmp"
+    md5 = hashlib.md5()
+    try:
+        _patch(path, delta_path, block_size, tmp_path, md5)
+    finally:
+        os.remove(delta_path)
+    if md5.hexdigest() != expected:
+        os.remove(tmp_path)
+        sys.stderr.write("md5 mismatch: " + md5.hexdigest())
+        sys.exit(1)
+    os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    os.replace(tmp_path, path)
+    return md5.hexdigest()
+
+
+def _patch(path, delta_path, block_size, tmp_path, md5):
+    with open(path, "rb") as old, open(delta_path, "rb") as delta, \
+            open(tmp_path, "wb") as new:
+        while True:
+            op = delta.read(1)
+            if not op:
+                break
+            if op == b"C":
+                start, count = struct.unpack(">II", delta.read(8))
+                old.seek(start * block_size)
+                src, length = old, count * block_size
+            else:
+                length, = struct.unpack(">I", delta.read(4))
+                src = delta
+            while length > 0:
+                data = src.read(min(length, 1 << 20))
+                if not data:
+                    break
+                md5.update(data)
+                new.write(data)
+                length -= len(data)
+
+
+if sys.argv[1] == "signature":
+    block_size = int(sys.argv[2])
+    json.dump(dict((p, signature(p, block_size)) for p in sys.argv[3:]),
+              sys.stdout)
+else:
+    sys.stdout.write(
+        patch(sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5]))
+'''
+MOD_ADLER = 65521
+
+
+def remote_command(python, *args):
+    """
+    把 REMOTE_HELPER 编码后通过 python -c 执行, 不需要在远程主机上安装任何文件
+    """
+    code = base64.b64encode(REMOTE_HELPER.encode()).decode()
+    return ' '.join(
+        [python, '-c',
+         shlex.quote(f'import base64;exec(base64.b64decode("{code}"))')]
+        + [shlex.quote(str(a)) for a in args])
+
+
+def get_block_size(size: int, block_size: int = None):
+    """
+    与 rsync 相同, 默认块大小约为文件大小的平方根
+    """
+    if block_size:
+        return block_size
+    return min(max(math.isqrt(size), 2048), 128 * 1024)
+
+
+def signatures(con: Connection, paths: list, block_size: int,
+               python: str = 'python3'):
+    """
+    一次远程调用获取多个文件的块签名
+    :return: {path: {'size': int, 'blocks': [[weak, strong], ...]} or None}
+    """
+    res = con.run(remote_command(python, 'signature', block_size, *paths),
+                  hide=True, warn=True)
+    if res.failed:
+        raise RuntimeError(res.stderr.strip() or f'exit {res.exited}')
+    return json.loads(res.stdout)
+
+
+def compute_delta(data, block_size: int, blocks: list, resync: int = 16):
+    """
+    在本地文件中查找远程已有的块, 块对齐时直接用 zlib.adler32 计算,
+    不匹配时在之后的两个块中逐字节滚动 adler32, 找回插入/删除后的位置,
+    仍未找到时每 resync 个块才再滚动一次, 以限制纯 python 循环的开销。
+    :param data: bytes 或 mmap
+    :return: [('C', start, count) or ('D', start, end)], 匹配的字节数
+    """
+    index = {}
+    for i, (weak, strong) in enumerate(blocks):
+        index.setdefault(weak, {}).setdefault(strong, i)
+    ops = []
+    matched = 0
+    literal = 0
+    p = 0
+    misses = 0
+    size = len(data)
+
+    def find(pos, weak):
+        candidates = index.get(weak)
+        if candidates:
+            return candidates.get(
+                hashlib.md5(data[pos:pos + block_size]).hexdigest())
+
+    def emit_copy(pos, i):
+        nonlocal literal
+        if literal < pos:
+            ops.append(('D', literal, pos))
+        if ops and ops[-1][0] == 'C' and \
+                ops[-1][1] + ops[-1][2] == i:
+            ops[-1] = ('C', ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append(('C', i, 1))
+        literal = pos + block_size
+
+    while p + block_size <= size:
+        weak = zlib.adler32(data[p:p + block_size])
+        i = find(p, weak)
+        if i is not None:
+            emit_copy(p, i)
+            matched += block_size
+            p += block_size
+            misses = 0
+            continue
+        if misses < 2 or misses % resync == 0:
+            a, b = weak & 0xffff, weak >> 16
+            end = min(p + block_size, size - block_size)
+            q = p
+            while q < end:
+                out, in_ = data[q], data[q + block_size]
+                a = (a - out + in_) % MOD_ADLER
+                b = (b - block_size * out + a - 1) % MOD_ADLER
+                q += 1
+                i = find(q, a | b << 16)
+                if i is not None:
+                    break
+            if i is not None:
+                emit_copy(q, i)
+                matched += block_size
+                p = q + block_size
+                misses = 0
+                continue
+        misses += 1
+        p += block_size
+    if literal < size:
+        ops.append(('D', literal, size))
+    return ops, matched
+
+
+def encode_delta(data, ops):
+    buf = io.BytesIO()
+    for op, start, end in ops:
+        if op == 'C':
+            buf.write(b'C' + struct.pack('>II', start, end))
+        else:
+            while start < end:
+                chunk = data[start:min(end, start + 0xffffffff)]
+                buf.write(b'D' + struct.pack('>I', len(chunk)))
+                buf.write(chunk)
+                start += len(chunk)
+    buf.seek(0)
+    return buf
+
+
+def put_delta(con: Connection, src: str, dst_path: str, conf: dict = None,
+              sftp: SFTPClient = None):
+    """
+    只发送远程文件中没有的数据块, 远程文件不存在, 不能执行 python
+    或者差异太大时返回 None, 由调用方完整上传。
+    :param sftp: 上传差异使用的 SFTP 客户端, 一般为 TransferSession.sftp
+    :return: 实际发送的字节数
+    """
+    conf = conf if conf is not None else CONF.get('DeltaSync') or {}
+    python = conf.get('python', 'python3')
+    size = Path(src).stat().st_size
+    if not size or size < conf.get('min_size', 1024 * 1024):
+        return None
+    block_size = get_block_size(size, conf.get('block_size'))
+    try:
+        sig = signatures(con, [dst_path], block_size, python)[dst_path]
+    except (RuntimeError, ValueError) as e:
+        logger.warning(f'{con.host}: delta sync unavailable: {e}')
+        return None
+    if not sig or not sig['blocks']:
+        return None
+    with open(src, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        ops, matched = compute_delta(data, block_size, sig['blocks'])
+        sent = size - matched
+        if sent > size * conf.get('max_ratio', 0.5):
+            logger.info(f'{src}: {sent} of {size} bytes changed, '
+                        f'sending whole file')
+            return None
+        delta = encode_delta(data, ops)
+        md5 = hashlib.md5(data).hexdigest()
+    delta_path = dst_path + '.delta'
+    (sftp or con.sftp()).putfo(delta, delta_path)
+    res = con.run(
+        remote_command(python, 'patch', dst_path, delta_path, block_size,
+                       md5),
+        hide=True, warn=True)
+    if res.failed or res.stdout.strip() != md5:
+        logger.error(f'{con.host}: patch {dst_path} failed: '
+                     f'{res.stderr.strip() or res.stdout.strip()}')
+        con.run(f'rm -f {shlex.quote(delta_path)} '
+                f'{shlex.quote(dst_path + ".delta.tmp")}',
+                hide=True, warn=True)
+        return None
+    logger.info(f'{con.host}: delta {dst_path}, '
+                f'sent {sent} of {size} bytes')
+    return sent
@@ -5,7 +5,6 @@
 import argparse
 import atexit
 import os
-import re
 import signal
 import socket
 import sys
@@ -19,7 +18,9 @@ from watchdog.observers import Observer
 
 from _sync import SyncEventHandler
 from conf import CONF, logger, load_conf
-from util import generate_yaml, ConnectionException, put_one
+from manifest import Manifest, relative_path
+from util import (
+    generate_yaml, ConnectionException, put_one, push_tar, PathFilter, )
 
 
 base_path = Path(__file__).parent
@@ -38,6 +39,9 @@ e.g:\n
         .\\virtenv\\Scripts\\python.exe manager.py util --push\n
     unix:\n
         ./virtenv/bin/python manager.py util --push\n
+第一次推送整个项目时, 打包成 tar 流推送:\n
+    unix:\n
+        ./virtenv/bin/python manager.py util --push --bulk\n
 debug运行模式:
 记录日志到日志文件时, 也会在当前命令行显示日志, 同时会抛出所有异常:\n
     Windows:\n
@@ -60,6 +64,15 @@ util_cmd = subcmd.add_parser('util',
                              help='push once project or generate conf file')
 util_cmd.add_argument('--push', action='store_true',
                       help='push once project')
+util_cmd.add_argument('--bulk', action='store_true',
+                      help='push as one tar stream, requires tar on the '
+                           'remote host')
+util_cmd.add_argument('--verify', action='store_true',
+                      help='check the manifest against sha256sum on the '
+                           'remote host before pushing')
+util_cmd.add_argument('--compress_level', type=int, default=1,
+                      help='gzip level of --bulk, 0 disables compression, '
+                           'default: 1')
 conf_def_path = (base_path / 'sync_project.yaml').absolute()
 util_cmd.add_argument('--conf_gen', action='store_const', const=conf_def_path,
                       help=f'Generate the configuration template file, '
@@ -67,6 +80,7 @@ util_cmd.add_argument('--conf_gen', action='store_const', const=conf_def_path,
 args = parser.parse_args()
 
 observer_instances = []
+handler_instances = []
 
 
 def ending(signum=None, frame=None):
@@ -74,6 +88,9 @@ def ending(signum=None, frame=None):
     for ob_instance in observer_instances:
         ob_instance.stop()
         ob_instance.join()
+    # 同步还在队列中的事件
+    for handler in handler_instances:
+        handler.close()
     sys.exit(1)
 
 
@@ -85,10 +102,12 @@ if __name__ == '__main__':
 
             for sd_instance in CONF['Sync']:
                 observer = Observer()
-                observer.schedule(SyncEventHandler(**sd_instance),
-                                  sd_instance['source'], recursive=True)
+                handler = SyncEventHandler(**sd_instance)
+                observer.schedule(handler, sd_instance['source'],
+                                  recursive=True)
                 observer.start()
                 observer_instances.append(observer)
+                handler_instances.append(handler)
             atexit.register(ending)
             signal.signal(signal.SIGINT, ending)
             signal.signal(signal.SIGTERM, ending)
@@ -114,8 +133,10 @@ if __name__ == '__main__':
         time_list = {}
         for sd_instance in CONF['Sync']:
             src = sd_instance['source']
-            regexes = sd_instance['regexes']
-            ignore_regexes = sd_instance['ignore_regexes']
+            path_filter = PathFilter(
+                sd_instance.get('regexes'),
+                sd_instance.get('ignore_regexes') or (),
+                sd_instance.get('case_sensitive', True))
             dsts = sd_instance['destinations']
             for dst in dsts:
                 with Connection(host=dst['host'], port=dst['port'],
@@ -125,37 +146,50 @@ if __name__ == '__main__':
                     try:
                         c.run('hostname', hide=True)
                         start_time = time.time()
+                        manifest = Manifest.for_destination(
+                            dst['host'], dst['path'], dst['port'])
+                        if args.bulk and dst['path'].startswith('/'):
+                            files = push_tar(src, dst['path'], c,
+                                             path_filter,
+                                             args.compress_level)
+                            # 记录实际发送的内容, 而不是推送后本地的文件
+                            manifest.update({
+                                relative_path(src, path): entry
+                                for path, entry in files.items()})
+                            manifest.save()
+                            time_list[dst['path']] = time.time() - start_time
+                            continue
+                        if args.verify:
+                            manifest.verify(c, dst['path'])
+                        files = [os.path.join(b, fs) for b, d, f in
+                                 path_filter.walk(src) for fs in f]
+                        # 只推送内容与清单不同的文件
+                        changed, entries = manifest.diff(src, files)
+                        logger.info(f'{dst["path"]}: {len(changed)} of '
+                                    f'{len(files)} files changed')
                         now_size = 0
-                        full_size = Path(src).stat().st_size
-                        for p in Path(src).iterdir():
-                            ps = p.absolute().__str__()
-                            if any(re.match(r, ps) for r in ignore_regexes):
-                                continue
-                            else:
-                                if p.is_file():
-                                    size = put_one(src, ps, dst['path'], c)
-                                    now_size += size
-                                    logger.info(
-                                        f'{dst["path"]}:progress======>>'
-                                        f'{now_size / full_size * 100}%')
-                                elif p.is_dir():
-                                    for b, d, f in os.walk(ps):
-                                        for fs in f:
-                                            src_ = Path(b) / fs
-                                            src_ = src_.__str__()
-                                            size = put_one(src, src_,
-                                                           dst['path'], c)
-                                            now_size += size
-                                            logger.info(
-                                                f'{dst["path"]}:'
-                                                f'progress======>>'
-                                                f'{now_size / full_size * 100}%'
-                                            )
+                        full_size = sum(e[0] for e in entries.values()) or 1
+                        try:
+                            for src_ in changed:
+                                size = put_one(src, src_, dst['path'], c)
+                                if size is None:
+                                    continue
+                                rel = relative_path(src, src_)
+                                manifest.update({rel: entries[rel]})
+                                now_size += size
+                                logger.info(
+                                    f'{dst["path"]}:progress======>>'
+                                    f'{now_size / full_size * 100}%')
+                        finally:
+                            manifest.save()
                         time_list[dst['path']] = time.time() - start_time
                     except (AuthenticationException, NoValidConnectionsError,
                             socket.timeout, SSHException, socket.error) as e:
                         logger.error(e)
                         raise ConnectionException(e)
+                    except RuntimeError as e:
+                        # 远程的 tar 失败时只跳过这个目标, 继续推送其余目标
+                        logger.error(e)
         if time_list:
             logger.info(f'elapsed time:\n{time_list}')
     elif getattr(args, 'conf_gen', None):
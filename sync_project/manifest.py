@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""The Module Has Been Build for content-hash manifest of destinations"""
+import hashlib
+import json
+import mmap
+import os
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from fabric import Connection
+
+from conf import CONF, logger
+
+
+# 大于这个大小的文件通过 mmap 计算 sha256, hashlib 在计算时会释放 GIL
+MMAP_SIZE = 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path) -> str:
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return hashlib.sha256(m).hexdigest()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+def relative_path(base_src: str, path: str) -> str:
+    # 十万个文件时 Path.relative_to 太慢, 绝对路径直接截取
+    base_src = os.path.join(os.path.abspath(base_src), '')
+    if not os.path.isabs(path):
+        path = os.path.abspath(path)
+    if not path.startswith(base_src):
+        raise ValueError(f'{path} 没有被包含在 {base_src} 的目录树内')
+    return path[len(base_src):].replace(os.sep, '/')
+
+
+def scan_tree(root: str, ignored=None, workers: int = None) -> dict:
+    """
+    在线程池中并行地用 os.scandir 遍历目录树, 每个目录一个任务,
+    目录的读取和其中文件的 stat 调用分散在多个线程中执行。
+    :param ignored: ignored(path) 为 True 的文件和目录被跳过, 目录不再进入
+    :return: {文件的绝对路径: (size, mtime_ns)}
+    """
+    def scan(path):
+        files, dirs = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if ignored is not None and ignored(entry.path):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files.append(
+                                (entry.path, st.st_size, st.st_mtime_ns))
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f'scan {path} failed: {e!r}')
+        return files, dirs
+
+    result = {}
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(scan, os.path.abspath(root))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                for path, size, mtime_ns in files:
+                    result[path] = (size, mtime_ns)
+                pending.update(pool.submit(scan, d) for d in dirs)
+    return result
+
+
+class Manifest(object):
+    """
+    一个目标一个, 记录目标上每个文件的 size, mtime_ns 和 sha256,
+    保存在本地, 推送时只发送有变化的文件。
+    size 和 mtime_ns 没有变化时不重新计算 sha256。
+    """
+
+    def __init__(self, path, workers: int = None):
+        self.path = Path(path)
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        # 相对路径 -> [size, mtime_ns, sha256]
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def for_destination(cls, host, base_dst: str, port=None) -> 'Manifest':
+        manifest_dir = Path(CONF.get('ManifestDir') or
+                            Path(__file__).parent / 'manifests')
+        digest = hashlib.sha1(base_dst.encode()).hexdigest()[:12]
+        manifest = cls(manifest_dir / f'{host}_{port or 22}_{digest}.json')
+        manifest.load()
+        return manifest
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f'load manifest {self.path} failed: {e!r}')
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            entries = dict(self.entries)
+            self.dirty = False
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def scan(self, base_src: str, files) -> dict:
+        """
+        计算文件当前的状态, 与清单中 size 和 mtime_ns 相同的文件直接使用
+        清单中的 sha256, 其余文件在线程池中计算。
+        :param files: 文件路径的列表, 或者 scan_tree 的结果
+        :return: {相对路径: [size, mtime_ns, sha256]}
+        """
+        state = {}
+        to_hash = []
+        if not isinstance(files, dict):
+            files = {path: None for path in files}
+        for path, stat in files.items():
+            if stat is None:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stat = (st.st_size, st.st_mtime_ns)
+            rel = relative_path(base_src, path)
+            entry = self.entries.get(rel)
+            if entry and entry[0] == stat[0] and entry[1] == stat[1]:
+                state[rel] = entry
+            else:
+                state[rel] = [stat[0], stat[1], None]
+                to_hash.append((rel, path))
+        if to_hash:
+            with ThreadPoolExecutor(self.workers) as pool:
+                hashes = pool.map(self._hash, (p for _, p in to_hash))
+                for (rel, _), sha256 in zip(to_hash, hashes):
+                    if sha256 is None:
+                        del state[rel]
+                    else:
+                        state[rel][2] = sha256
+        return state
+
+    @staticmethod
+    def _hash(path):
+        try:
+            return hash_file(path)
+        except OSError as e:
+            logger.warning(f'hash {path} failed: {e!r}')
+            return None
+
+    def diff(self, base_src: str, files):
+        """
+        :return: 内容与清单不同的文件的绝对路径, 以及这些文件当前的状态;
+                 内容相同只是 mtime 变化的文件直接更新清单
+        """
+        state = self.scan(base_src, files)
+        changed = {}
+        with self.lock:
+            for rel, entry in state.items():
+                old = self.entries.get(rel)
+                if old and old[2] == entry[2]:
+                    if old is not entry:
+                        self.entries[rel] = entry
+                        self.dirty = True
+                else:
+                    changed[rel] = entry
+        base_src = Path(base_src).absolute()
+        return [str(base_src / rel) for rel in changed], changed
+
+    def reconcile(self, base_src: str, stats: dict):
+        """
+        比较整个目录树与清单
+        :param stats: scan_tree 的结果
+        :return: 需要上传的文件的绝对路径和状态, 本地已经删除的文件的相对路径,
+                 只包括同步成功后记录了 size 的文件
+        """
+        changed, entries = self.diff(base_src, stats)
+        present = {relative_path(base_src, path) for path in stats}
+        with self.lock:
+            # 旧版本的 verify 会加入只有 sha256 的远程文件, 不能删除
+            deleted = [rel for rel, entry in self.entries.items()
+                       if rel not in present and entry[0] is not None]
+        return changed, entries, deleted
+
+    def update(self, entries: dict):
+        with self.lock:
+            self.entries.update(entries)
+            self.dirty = True
+
+    def move(self, src_rel: str, dst_rel: str):
+        """
+        文件或目录移动后, 把 src_rel 以及它下面的文件改到 dst_rel 下
+        """
+        prefix = src_rel.rstrip('/') + '/'
+        with self.lock:
+            for key in [k for k in self.entries
+                        if k == src_rel or k.startswith(prefix)]:
+                self.entries[dst_rel + key[len(src_rel):]] = \
+                    self.entries.pop(key)
+                self.dirty = True
+
+    def forget(self, rel: str):
+        """
+        删除 rel 以及它下面的所有文件
+        """
+        prefix = rel.rstrip('/') + '/'
+        with self.lock:
+            for key in [k for k in self.entries
+                        if k == rel or k.startswith(prefix)]:
+                del self.entries[key]
+                self.dirty = True
+
+    def verify(self, con: Connection, base_dst: str):
+        """
+        用远程的 sha256sum 校验清单, 远程没有或者内容不同的文件从清单中删除。
+        只存在于远程的文件不是由这里推送的, 不加入清单, 也就不会被删除。
+        """
+        quoted = shlex.quote(base_dst)
+        res = con.run(f'cd {quoted} && find . -type f -print0 '
+                      f'| xargs -0 -r sha256sum', hide=True, warn=True)
+        if res.failed:
+            logger.error(f'{con.host}: sha256sum failed: {res.stderr}')
+            return
+        remote = {}
+        for line in res.stdout.splitlines():
+            sha256, _, path = line.partition('  ')
+            if path.startswith('./'):
+                remote[path[2:]] = sha256
+        with self.lock:
+            for rel, entry in list(self.entries.items()):
+                if remote.get(rel) != entry[2]:
+                    del self.entries[rel]
+            self.dirty = True
+        logger.info(f'{con.host}: verified {len(self.entries)} files')
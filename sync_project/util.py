@@ -1,19 +1,38 @@
 # -*- coding: utf-8 -*-
 # Author      : ShiFan
 # Created Date: 2019/10/16 11:50
+import errno
 import functools
+import gzip
+import hashlib
 import os
+import posixpath
+import re
+import shlex
+import socket
+import stat
+import tarfile
+import threading
+import time
 from pathlib import Path
 
 from fabric import Connection
+from paramiko import SFTPClient, SSHException
+from paramiko.ssh_exception import NoValidConnectionsError
 
 from conf import CONF, logger
+from delta import put_delta
 
 
 class ConnectionException(Exception):
     """connection error """
 
 
+# 连接断开时的异常, 由调用方重新连接
+CONNECTION_ERRORS = (SSHException, NoValidConnectionsError, socket.timeout,
+                     ConnectionError, EOFError)
+
+
 def ip_check(ip_address):
     try:
         import ipaddress
@@ -50,6 +69,18 @@ def generate_yaml(yaml_path=None):
         yaml_path = Path(__file__).parent / 'sync_project.yaml'
     template_yaml = """
 LOG_Level: WARN
+# 只发送变化的数据块, 需要远程主机可以执行 python3
+DeltaSync:
+  enabled: false
+  # 小于 min_size 字节的文件直接上传
+  min_size: 1048576
+  # 默认为文件大小的平方根
+  block_size: null
+  # 变化超过这个比例时直接上传整个文件
+  max_ratio: 0.5
+  python: python3
+# 每个目标的文件清单 (size, mtime, sha256) 保存的目录, 默认为 ./manifests
+# ManifestDir: ./manifests
 Sync:
   - source: E:\\absolute_path\\root_directory
     destinations:
@@ -74,6 +105,10 @@ Sync:
       - ".*.py_.*"
     ignore_directories: false
     case_sensitive: true
+    # 同一个文件在 quiet_window 秒内的多次事件合并为一次同步
+    quiet_window: 0.5
+    # ssh keepalive 和检查连接状态的间隔(秒)
+    keepalive: 30
   - source: F:\\absolute_path\\root_directory
     destinations:
       - host: host ip
@@ -92,15 +127,65 @@ Sync:
       - ".*.py_.*"
     ignore_directories: false
     case_sensitive: true
+    quiet_window: 0.5
+    keepalive: 30
     """
     with open(yaml_path, 'w', encoding="utf8") as f:
         f.write(template_yaml)
     return yaml_path, template_yaml
 
 
+class PathFilter(object):
+    """
+    只编译一次 regexes 和 ignore_regexes, 由 SyncEventHandler 和 push 共用。
+    被忽略的目录下的所有路径都被忽略, 遍历时不再进入,
+    每个目录是否被忽略的结果会被缓存。
+    """
+
+    def __init__(self, regexes=None, ignore_regexes=(),
+                 case_sensitive=True, cache_size=65536):
+        flags = 0 if case_sensitive else re.I
+        self.regexes = [re.compile(r, flags) for r in regexes or [r'.*']]
+        self.ignore_regexes = [re.compile(r, flags) for r in ignore_regexes]
+        self.ignored_dir = functools.lru_cache(maxsize=cache_size)(
+            self._ignored_dir)
+
+    def _ignore(self, path) -> bool:
+        return any(r.match(path) for r in self.ignore_regexes)
+
+    def _ignored_dir(self, path) -> bool:
+        parent = os.path.dirname(path)
+        return self._ignore(path) or (
+            parent != path and self.ignored_dir(parent))
+
+    def ignored(self, path) -> bool:
+        """
+        path 本身或者它所在的目录被忽略
+        """
+        return self._ignore(path) or self.ignored_dir(os.path.dirname(path))
+
+    def match(self, path) -> bool:
+        return not self.ignored(path) and \
+            any(r.match(path) for r in self.regexes)
+
+    def walk(self, root):
+        """
+        与 os.walk 相同, 被忽略的目录不会被进入, 文件只保留匹配的
+        """
+        for b, d, f in os.walk(os.path.abspath(root)):
+            d[:] = [n for n in d if not self._ignore(os.path.join(b, n))]
+            yield b, d, [n for n in f if self._match_file(os.path.join(b, n))]
+
+    def _match_file(self, path) -> bool:
+        # 所在的目录在遍历时已经检查过
+        return not self._ignore(path) and \
+            any(r.match(path) for r in self.regexes)
+
+
 def enforce(method):
     """
-    当为normal模式时, 不捕获异常, 强制继续运行
+    当为normal模式时, 不捕获异常, 强制继续运行,
+    连接错误总是抛出, 由调用方重新连接
     :return:
     """
 
@@ -108,6 +193,8 @@ def enforce(method):
     def wrapper(*args, **kwargs):
         try:
             return method(*args, **kwargs)
+        except CONNECTION_ERRORS:
+            raise
         except Exception as e:
             logger.warning(method.__str__())
             logger.error(e)
@@ -115,6 +202,94 @@ def enforce(method):
     return wrapper
 
 
+class TransferSession(object):
+    """
+    一个远程连接一个, 复用同一个 SFTP 客户端,
+    记录已经存在的远程目录, 缺少的目录通过 SFTP 创建, 不再执行 mkdir -p。
+    """
+
+    def __init__(self, con: Connection):
+        self.con = con
+        self.dirs = set()
+        self.lock = threading.Lock()
+        self._sftp = None
+
+    @property
+    def sftp(self) -> SFTPClient:
+        """
+        fabric 2 的 Connection.close() 不清除缓存的 SFTP 客户端,
+        重连后由这里在新的 transport 上重新打开
+        """
+        if not self.con.is_connected:
+            self.con.open()
+        transport = self.con.transport
+        sftp = self._sftp
+        if sftp is None or sftp.get_channel().closed \
+                or sftp.get_channel().get_transport() is not transport:
+            if sftp is not None:
+                sftp.close()
+            sftp = self._sftp = transport.open_sftp_client()
+        return sftp
+
+    def makedirs(self, paths):
+        """
+        创建多个远程目录, 父目录在前, 已经存在或创建过的目录不再请求
+        """
+        missing = set()
+        for path in paths:
+            path = path.rstrip('/') or '/'
+            while path not in self.dirs and path not in missing \
+                    and path != '/':
+                missing.add(path)
+                path = posixpath.dirname(path)
+        for path in sorted(missing):
+            if path in self.dirs:
+                continue
+            try:
+                self.sftp.mkdir(path)
+            except IOError as e:
+                # SFTP 的 mkdir 对已经存在的目录只返回 Failure
+                if e.errno == errno.ENOENT or not stat.S_ISDIR(
+                        self.sftp.stat(path).st_mode):
+                    raise
+            with self.lock:
+                self.dirs.add(path)
+
+    def forget(self, path):
+        """
+        远程目录被删除或移动后调用
+        """
+        path = path.rstrip('/')
+        prefix = path + '/'
+        with self.lock:
+            self.dirs = {d for d in self.dirs
+                         if d != path and not d.startswith(prefix)}
+
+    def put(self, src: str, dst_path: str):
+        try:
+            self.sftp.put(src, dst_path)
+        except IOError as e:
+            if e.errno != errno.ENOENT or not dst_path.startswith('/'):
+                raise
+            # 目录在其他地方被删除了, 重新检查整条路径
+            parent = posixpath.dirname(dst_path)
+            self.forget(parent)
+            with self.lock:
+                path = parent
+                while path != '/':
+                    path = posixpath.dirname(path)
+                    self.dirs.discard(path)
+            self.makedirs([parent])
+            self.sftp.put(src, dst_path)
+
+
+def get_session(con: Connection) -> TransferSession:
+    session = getattr(con, 'transfer_session', None)
+    if session is None:
+        session = con.transfer_session = TransferSession(con)
+    return session
+
+
 @enforce
 def put_one(base_src: str, src: str, base_dst: str, con: Connection):
     base_src = Path(base_src).absolute().__str__()
@@ -122,19 +297,147 @@ def put_one(base_src: str, src: str, base_dst: str, con: Connection):
     assert Path(src).is_file(), 'src must be file'
     dst_path = get_dest_path(base_src, src, base_dst)
     dst_parent = os.path.split(dst_path)[0]
+    session = get_session(con)
     if dst_path.startswith('/'):
-        con.run(f"mkdir -p {dst_parent}")
+        session.makedirs([dst_parent])
     else:
         # TODO: windows command
         pass
     logger.info(f'src: {src}')
     logger.info(f'pushing to {con.host}: {dst_path}')
-    con.put(src, dst_path, preserve_mode=False)
     file_size = Path(src).stat().st_size
+    if dst_path.startswith('/') and (CONF.get('DeltaSync') or {}).get(
+            'enabled'):
+        if put_delta(con, src, dst_path, sftp=session.sftp) is not None:
+            return file_size
+    session.put(src, dst_path)
     logger.info(f'file size: {file_size / 1024 / 1024}M')
     return file_size
 
 
+class _TarSource(object):
+    """
+    tarfile 按 tarinfo.size 读取文件内容, 文件在打包时变短或读取失败时
+    用 0 补足剩余的长度, 与 GNU tar 相同, 不破坏整个 tar 流。
+    同时计算实际发送的内容的 sha256。
+    """
+
+    def __init__(self, fo, path):
+        self.fo = fo
+        self.path = path
+        self.short = False
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size):
+        data = b''
+        if not self.short:
+            try:
+                data = self.fo.read(size)
+            except OSError as e:
+                logger.warning(f'read {self.path} failed: {e!r}')
+            if len(data) < size:
+                self.short = True
+        data += bytes(size - len(data))
+        self.sha256.update(data)
+        return data
+
+
+def _open_member(tar: tarfile.TarFile, path: str, arcname: str):
+    """
+    普通文件先打开再用 fstat 生成 tarinfo, 大小与之后读取的内容一致
+    :return: (tarinfo, 打开的普通文件或 None), 无法读取时为 (None, None)
+    """
+    fo = None
+    try:
+        if stat.S_ISREG(os.lstat(path).st_mode):
+            fo = open(path, 'rb')
+            return tar.gettarinfo(arcname=arcname, fileobj=fo), fo
+        return tar.gettarinfo(path, arcname), None
+    except OSError as e:
+        if fo is not None:
+            fo.close()
+        logger.warning(f'skip {path}: {e!r}')
+        return None, None
+
+
+def push_tar(base_src: str, base_dst: str, con: Connection,
+             path_filter: PathFilter = None, compress_level: int = 1):
+    """
+    把整个目录打包成 tar 流, 通过一个 ssh exec 通道交给远程的 tar -x,
+    边打包边发送, 内存占用只有 tarfile 和 gzip 的缓冲区,
+    速度不再受每个文件的往返延迟限制。
+    打包时已经消失或无法读取的文件被跳过, 不中断整个 tar 流。
+    :param compress_level: gzip 压缩级别, 0 为不压缩
+    :return: 完整发送的文件及其 [size, mtime_ns, sha256], 打包时有变化的
+             文件不包括在内, 下次推送时重新比较
+    """
+    base_src = Path(base_src).absolute()
+    path_filter = path_filter or PathFilter()
+    quoted = shlex.quote(base_dst)
+    command = (f"mkdir -p {quoted} && tar -x{'z' if compress_level else ''}"
+               f" --no-same-owner -f - -C {quoted}")
+    con.open()
+    channel = con.transport.open_session()
+    channel.exec_command(command)
+    stream = channel.makefile('wb')
+    if compress_level:
+        stream = gzip.GzipFile(fileobj=stream, mode='wb',
+                               compresslevel=compress_level)
+    start_time = time.time()
+    total_size = 0
+    files = {}
+    try:
+        with tarfile.open(fileobj=stream, mode='w|') as tar:
+            for b, d, f in path_filter.walk(base_src):
+                for name in d:
+                    path = os.path.join(b, name)
+                    info, _ = _open_member(
+                        tar, path, Path(path).relative_to(base_src).as_posix())
+                    if info is not None:
+                        tar.addfile(info)
+                for name in f:
+                    path = os.path.join(b, name)
+                    info, fo = _open_member(
+                        tar, path, Path(path).relative_to(base_src).as_posix())
+                    if info is None:
+                        continue
+                    if fo is None:
+                        tar.addfile(info)
+                        continue
+                    with fo:
+                        st = os.fstat(fo.fileno())
+                        source = _TarSource(fo, path)
+                        tar.addfile(info, source)
+                        changed = source.short or st.st_size != info.size \
+                            or os.fstat(fo.fileno()).st_mtime_ns \
+                            != st.st_mtime_ns
+                    total_size += info.size
+                    if changed:
+                        logger.warning(f'{path} changed while packing')
+                        continue
+                    files[path] = [info.size, st.st_mtime_ns,
+                                   source.sha256.hexdigest()]
+                    if len(files) % 1000 == 0:
+                        logger.info(f'{con.host}: {len(files)} files, '
+                                    f'{total_size / 1024 / 1024:.1f}M')
+        if compress_level:
+            stream.close()
+    except OSError as e:
+        # 远程的 tar 提前退出时发送会失败, 错误信息在 stderr 中
+        logger.error(f'{con.host}: {e!r}')
+    finally:
+        channel.shutdown_write()
+    status = channel.recv_exit_status()
+    stderr = channel.makefile_stderr('rb').read().decode(errors='replace')
+    channel.close()
+    if status:
+        raise RuntimeError(f'{con.host}: {command}: {stderr.strip()}')
+    elapsed = time.time() - start_time
+    logger.info(f'{con.host}: pushed {len(files)} files, '
+                f'{total_size / 1024 / 1024:.1f}M in {elapsed:.1f}s')
+    return files
+
+
 def get_dest_path(root_path: str, absolute_path: str, dest_base_path: str):
     if os.path.commonprefix([root_path, absolute_path]) != root_path:
         raise ValueError(f'{absolute_path} 没有被包含在 {root_path} 的目录树内')